@@ -1,25 +1,331 @@
+import gzip
 import logging
+import mmap
 import re
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import transaction
 from squad.plugins import Plugin as BasePlugin
+from squad.celery import app as celery
+from squad.core.models import Test, TestRun, PluginScratch
 
 
 logger = logging.getLogger()
 
+# number of tests whose logs are written with a single UPDATE. Can be
+# overridden with PLUGINS_LTP_LOG_UPDATE_BATCH_SIZE in django settings
+DEFAULT_LOG_UPDATE_BATCH_SIZE = 500
+
+# with PLUGINS_LTP_ASYNC set in django settings, logs are assigned by the
+# process_build_logs celery task, on the PLUGINS_LTP_QUEUE queue when it is
+# set. Testruns of a build received within PLUGINS_LTP_COALESCE_DELAY
+# seconds are processed by the same task. Coalescing across processes needs
+# a django cache shared by all of them (e.g. memcached or redis). With the
+# default per-process cache, every process schedules its own tasks, which
+# is still correct, just less efficient
+DEFAULT_ASYNC = False
+DEFAULT_COALESCE_DELAY = 10
+# the task starts this many seconds after the coalescing key expires, so a
+# testrun that saw the key is always found by the task
+COALESCE_COUNTDOWN_MARGIN = 5
+# testruns whose logs can't be assigned are retried this many times, every
+# PROCESS_BUILD_LOGS_RETRY_DELAY seconds
+PROCESS_BUILD_LOGS_MAX_RETRIES = 3
+PROCESS_BUILD_LOGS_RETRY_DELAY = 60
+# testruns waiting for process_build_logs are kept as PluginScratch rows
+# whose storage starts with this prefix, followed by the testrun ID
+SCRATCH_PREFIX = 'ltp-logs:'
+
+# size of the chunks read from log files that can't be memory mapped
+LOG_READ_CHUNK_SIZE = 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+# markers of the sections written by ltp-pan for every test
+PAN_TEST_START = '<<<test_start>>>'
+PAN_TEST_OUTPUT = '<<<test_output>>>'
+PAN_EXECUTION_STATUS = '<<<execution_status>>>'
+PAN_TEST_END = '<<<test_end>>>'
+PAN_FIELD_REGEX = re.compile(r'(\w+)=("[^"]*"|\S*)')
+
+
+def iterate_lines(fileobj, chunk_size=LOG_READ_CHUNK_SIZE):
+    """
+    Yields the lines of a binary file object, read in chunks and split on
+    b"\n" only, like str.split("\n").
+    """
+    remainder = b''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+    yield remainder
+
+
+def iterate_mapped_lines(mapped):
+    start = 0
+    while True:
+        end = mapped.find(b'\n', start)
+        if end == -1:
+            yield mapped[start:]
+            return
+        yield mapped[start:end]
+        start = end + 1
+
+
+def read_log_lines(log_file):
+    """
+    Yields decoded lines of a log file stored with a FileField. Local files
+    are memory mapped, other storages are read in chunks. Gzip compressed
+    logs are decompressed on the fly. The file is read through its own
+    handle, so log_file itself is left untouched for other plugins.
+    """
+    mapped = None
+    fileobj = log_file.storage.open(log_file.name, 'rb')
+    try:
+        compressed = fileobj.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        fileobj.seek(0)
+        if compressed:
+            lines = iterate_lines(gzip.GzipFile(fileobj=fileobj, mode='rb'))
+        else:
+            try:
+                mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+                lines = iterate_mapped_lines(mapped)
+            except (AttributeError, OSError, ValueError):
+                # storage without a local file, or an empty file
+                lines = iterate_lines(fileobj)
+        for line in lines:
+            yield line.decode()
+    finally:
+        if mapped is not None:
+            mapped.close()
+        fileobj.close()
+
+
+class PanSection(object):
+    """
+    Output block of a single test in ltp-pan output. offset and length
+    locate the block in the log, counted in characters. output holds the
+    lines of the block when they were collected by PanLogParser.
+    """
+    __slots__ = ('tag', 'offset', 'length', 'duration', 'termination_type', 'termination_id', 'output')
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.offset = None
+        self.length = None
+        self.duration = None
+        self.termination_type = None
+        self.termination_id = None
+        self.output = None
+
+
+class PanLogParser(object):
+    """
+    Splits ltp-pan output into per-test sections while lines are passed
+    through scan(). sections maps each tag to its PanSection. Output lines
+    are only kept for the given tags, or for all tags when tags is None.
+    When a tag appears more than once, its last section is kept.
+    """
+
+    def __init__(self, tags=None):
+        self.tags = set(tags) if tags is not None else None
+        self.sections = {}
+
+    def scan(self, lines):
+        offset = 0
+        state = None
+        section = None
+        for line in lines:
+            yield line
+            line_offset = offset
+            offset += len(line) + 1
+            if line == PAN_TEST_START:
+                state = PAN_TEST_START
+                section = None
+            elif line == PAN_TEST_OUTPUT and state == PAN_TEST_START and section is not None:
+                state = PAN_TEST_OUTPUT
+                section.offset = offset
+                if self.tags is None or section.tag in self.tags:
+                    section.output = []
+            elif line == PAN_EXECUTION_STATUS and state == PAN_TEST_OUTPUT:
+                state = PAN_EXECUTION_STATUS
+                section.length = line_offset - section.offset
+            elif line == PAN_TEST_END and state == PAN_EXECUTION_STATUS:
+                self.sections[section.tag] = section
+                state = None
+                section = None
+            elif state == PAN_TEST_START:
+                fields = self.__fields(line)
+                if section is None and 'tag' in fields:
+                    section = PanSection(fields['tag'])
+            elif state == PAN_TEST_OUTPUT:
+                if section.output is not None:
+                    section.output.append(line)
+            elif state == PAN_EXECUTION_STATUS:
+                fields = self.__fields(line)
+                if 'duration' in fields:
+                    section.duration = fields['duration']
+                if 'termination_type' in fields:
+                    section.termination_type = fields['termination_type']
+                if 'termination_id' in fields:
+                    section.termination_id = fields['termination_id']
+
+    def __fields(self, line):
+        return {key: value.strip('"') for key, value in PAN_FIELD_REGEX.findall(line)}
+
+
+class PrefixMatcher(object):
+    """
+    Finds which of the given names each log line starts with. Names are
+    grouped by length, so a line is checked with one dict lookup per
+    distinct name length instead of one regex per name.
+    """
+
+    def __init__(self, names):
+        self.names = {}
+        for name in names:
+            self.names.setdefault(len(name), set()).add(name)
+        self.lengths = sorted(self.names)
+
+    def match(self, line):
+        for length in self.lengths:
+            if length > len(line):
+                break
+            prefix = line[:length]
+            if prefix in self.names[length]:
+                yield prefix
+
+    def find_lines(self, lines):
+        """
+        Returns a dict mapping names to the lines starting with them, in
+        log order.
+        """
+        matches = {}
+        for line in lines:
+            for name in self.match(line):
+                matches.setdefault(name, []).append(line)
+        return matches
+
+
+def build_task_key(build_id):
+    return 'ltp-logs-build-%s' % build_id
+
+
+@celery.task(bind=True, max_retries=PROCESS_BUILD_LOGS_MAX_RETRIES, default_retry_delay=PROCESS_BUILD_LOGS_RETRY_DELAY)
+def process_build_logs(self, build_id):
+    """
+    Assigns logs of all testruns of the build queued by LtpLogs, until no
+    queued testrun is left. Each testrun is processed in its own
+    transaction, together with the removal of its scratch row, so a retried
+    task doesn't assign logs twice. Testruns that fail are retried with the
+    whole task, and dropped once the retries are exhausted.
+    """
+    # testruns queued from now on are handled by a new task
+    django_cache.delete(build_task_key(build_id))
+    plugin = LtpLogs()
+    seen = set()
+    failed = set()
+    while True:
+        # rows locked by another task are left to it
+        scratch_ids = list(PluginScratch.objects.filter(
+            build_id=build_id,
+            storage__startswith=SCRATCH_PREFIX).exclude(pk__in=list(seen)).values_list('pk', flat=True))
+        if not scratch_ids:
+            break
+        for scratch_id in scratch_ids:
+            seen.add(scratch_id)
+            try:
+                process_scratch_logs(plugin, scratch_id)
+            except Exception as e:
+                logger.error("Unable to assign LTP logs from PluginScratch %s: %s" % (scratch_id, e))
+                failed.add(scratch_id)
+
+    if failed:
+        if self.request.retries < self.max_retries:
+            raise self.retry()
+        logger.error("Giving up assigning LTP logs from PluginScratch %s" % sorted(failed))
+        PluginScratch.objects.filter(pk__in=failed).delete()
+
+
+def process_scratch_logs(plugin, scratch_id):
+    with transaction.atomic():
+        scratch = PluginScratch.objects.select_for_update(skip_locked=True).filter(pk=scratch_id).first()
+        if scratch is None:
+            # processed by another task
+            return
+        testrun = TestRun.objects.filter(pk=int(scratch.storage[len(SCRATCH_PREFIX):])).first()
+        if testrun is not None:
+            logger.debug("Assigning LTP logs to testrun %s" % testrun.pk)
+            plugin._assign_logs(testrun)
+        scratch.delete()
+
 
 class LtpLogs(BasePlugin):
     name = "LTP Logs"
 
     def postprocess_testrun(self, testrun):
-        for test in testrun.tests.filter(result=False):
+        if getattr(settings, 'PLUGINS_LTP_ASYNC', DEFAULT_ASYNC):
+            self.__queue_testrun(testrun)
+        else:
+            self._assign_logs(testrun)
+
+    def __queue_testrun(self, testrun):
+        PluginScratch.objects.create(
+            build=testrun.build,
+            storage="%s%s" % (SCRATCH_PREFIX, testrun.pk))
+        delay = getattr(settings, 'PLUGINS_LTP_COALESCE_DELAY', DEFAULT_COALESCE_DELAY)
+        task_options = {'countdown': delay + COALESCE_COUNTDOWN_MARGIN}
+        queue = getattr(settings, 'PLUGINS_LTP_QUEUE', None)
+        if queue:
+            task_options['queue'] = queue
+        build_id = testrun.build_id
+
+        def schedule():
+            # only the first testrun of a build within the delay starts a task
+            if django_cache.add(build_task_key(build_id), True, delay):
+                process_build_logs.apply_async((build_id,), **task_options)
+
+        transaction.on_commit(schedule)
+
+    def _assign_logs(self, testrun):
+        tests = list(testrun.tests.filter(result=False))
+        if not tests:
+            return
+        # the log is scanned once for all failed tests. Lines are split on
+        # "\n" only, as "^name.*$" did with re.MULTILINE
+        matcher = PrefixMatcher(test.name for test in tests)
+        if testrun.log_file_storage:
+            # streamed, so the whole log is never kept in memory
+            lines = read_log_lines(testrun.log_file_storage)
+        else:
+            lines = testrun.log_file.split("\n")
+        # ltp-pan sections are split in the same pass. Tests with a
+        # section get its whole output block, the others the lines that
+        # start with the test name
+        parser = PanLogParser(test.name for test in tests)
+        matches = matcher.find_lines(parser.scan(lines))
+        updated_tests = []
+        for test in tests:
             logger.debug("Assigning LTP logs to %s" % test.name)
-            regex = re.compile("^%s.*$" % re.escape(test.name), re.MULTILINE)
-            log_results = regex.findall(testrun.log_file)
-            for match in log_results:
-                logger.debug("Found log line for test: %s" % test.name)
-                logger.debug(match)
-                if test.log is None:
-                    test.log = match
-                else:
-                    test.log = test.log + "\r" + match
-                test.save()
+            section = parser.sections.get(test.name)
+            if section is not None and section.output:
+                lines = section.output
+            else:
+                lines = matches.get(test.name)
+            if not lines:
+                continue
+            logger.debug("Found %s log lines for test: %s" % (len(lines), test.name))
+            if test.log is not None:
+                lines = [test.log] + lines
+            test.log = "\r".join(lines)
+            updated_tests.append(test)
 
+        if updated_tests:
+            logger.debug("Saving logs of %s tests" % len(updated_tests))
+            batch_size = getattr(settings, 'PLUGINS_LTP_LOG_UPDATE_BATCH_SIZE', DEFAULT_LOG_UPDATE_BATCH_SIZE)
+            with transaction.atomic():
+                Test.objects.bulk_update(updated_tests, ['log'], batch_size=batch_size)
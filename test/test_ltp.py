@@ -1,7 +1,24 @@
+import django
+import os
+
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'squad.settings'
+django.setup()
+
+
+import gzip
 import logging
+import os
+import tempfile
 import unittest
-from unittest.mock import PropertyMock, Mock
-from ltp import LtpLogs
+from celery.exceptions import Retry
+from django.core.files import File
+from django.test import override_settings
+from squad.core.models import TestRun
+from unittest.mock import PropertyMock, Mock, patch
+from io import BytesIO
+import ltp
+from ltp import LtpLogs, PanLogParser, PrefixMatcher, iterate_lines, read_log_lines
 
 
 TEST_LOG = """
@@ -13,6 +30,33 @@ test_3: some log 2
 test_3: some log 3
 test[a-1]: some log
 """
+PAN_LOG = """<<<test_start>>>
+tag=abort01 stime=1517218412
+cmdline="abort01"
+contacts=""
+analysis=exit
+<<<test_output>>>
+abort01     1  TPASS  :  Test passed
+<<<execution_status>>>
+initiation_status="ok"
+duration=0 termination_type=exited termination_id=0 corefile=no
+cutime=0 cstime=1
+<<<test_end>>>
+<<<test_start>>>
+tag=accept01 stime=1517218413
+cmdline="accept01 -i 2"
+contacts=""
+analysis=exit
+<<<test_output>>>
+tst_test.c:1106: INFO: Timeout per run is 0h 05m 00s
+accept01.c:82: FAIL: bad file descriptor failed unexpectedly
+accept01    1  TFAIL  :  bad file descriptor
+<<<execution_status>>>
+initiation_status="ok"
+duration=2 termination_type=exited termination_id=1 corefile=no
+cutime=0 cstime=3
+<<<test_end>>>
+"""
 
 logger = logging.getLogger()
 logger.setLevel(logging.ERROR)
@@ -22,28 +66,31 @@ class LtpLogsPluginTest(unittest.TestCase):
     def setUp(self):
         self.plugin = LtpLogs()
 
-    def test_postprocess_testrun(self):
+    @patch("ltp.transaction")
+    @patch("ltp.Test")
+    def test_postprocess_testrun(self, test_model_mock, transaction_mock):
         test_1 = Mock()
         test_1_name = PropertyMock(return_value="test_1")
         type(test_1).name = test_1_name
-        test_1_log = PropertyMock()
+        test_1_log = PropertyMock(return_value=None)
         type(test_1).log = test_1_log
 
         test_2 = Mock()
         test_2_name = PropertyMock(return_value="test_2")
         type(test_2).name = test_2_name
-        test_2_log = PropertyMock()
+        test_2_log = PropertyMock(return_value=None)
         type(test_2).log = test_2_log
 
         test_3 = Mock()
         test_3_name = PropertyMock(return_value="test_3")
         type(test_3).name = test_3_name
-        test_3_log = PropertyMock()
+        test_3_log = PropertyMock(return_value=None)
         type(test_3).log = test_3_log
 
         testrun = Mock()
         testrun_log = PropertyMock(return_value=TEST_LOG)
         type(testrun).log_file = testrun_log
+        testrun.log_file_storage = None
 
         testrun.tests = Mock()
         testrun.tests.filter.return_value = [test_1, test_2, test_3]
@@ -55,28 +102,31 @@ class LtpLogsPluginTest(unittest.TestCase):
         test_1_name.assert_called_with()
         # uncomment when running with python3.6
         #test_1_log.assert_called()
-        test_1.save.assert_called_with()
 
         # test_2 not present in the log
         test_2_name.assert_called_with()
         test_2_log.assert_not_called()
-        test_2.save.assert_not_called()
 
         test_3_name.assert_called_with()
         # uncomment when running with python3.6
         #test_3_log.assert_called()
-        test_3.save.assert_called_with()
+        test_model_mock.objects.bulk_update.assert_called_once_with([test_1, test_3], ['log'], batch_size=500)
+        transaction_mock.atomic.assert_called_once_with()
+        test_1.save.assert_not_called()
 
-    def test_tests_with_regex_characters(self):
+    @patch("ltp.transaction")
+    @patch("ltp.Test")
+    def test_tests_with_regex_characters(self, test_model_mock, transaction_mock):
         test = Mock()
         test_name = PropertyMock(return_value="test[a-1]")
         type(test).name = test_name
-        test_log = PropertyMock()
+        test_log = PropertyMock(return_value=None)
         type(test).log = test_log
 
         testrun = Mock()
         testrun_log = PropertyMock(return_value=TEST_LOG)
         type(testrun).log_file = testrun_log
+        testrun.log_file_storage = None
 
         testrun.tests = Mock()
         testrun.tests.filter.return_value = [test]
@@ -86,7 +136,176 @@ class LtpLogsPluginTest(unittest.TestCase):
         test_name.assert_called_with()
         # uncomment when running with python3.6
         #test_log.assert_called()
-        test.save.assert_called_with()
+        test_model_mock.objects.bulk_update.assert_called_once_with([test], ['log'], batch_size=500)
+
+    def test_prefix_matcher(self):
+        matcher = PrefixMatcher(["test_1", "test_10", "test[a-1]", "test_2"])
+        lines = TEST_LOG.split("\n") + ["test_10: some log", "xtest_1: some log"]
+        matches = matcher.find_lines(lines)
+        self.assertEqual(
+            ["test_1: some log 1", "test_1: some log 2", "test_1: some log 3", "test_10: some log"],
+            matches["test_1"])
+        self.assertEqual(["test_10: some log"], matches["test_10"])
+        self.assertEqual(["test[a-1]: some log"], matches["test[a-1]"])
+        self.assertNotIn("test_2", matches)
+
+    @override_settings(PLUGINS_LTP_LOG_UPDATE_BATCH_SIZE=10)
+    @patch("ltp.transaction")
+    @patch("ltp.Test")
+    def test_postprocess_testrun_log_contents(self, test_model_mock, transaction_mock):
+        test = Mock(log=None)
+        test.name = "test_3"
+        test_with_log = Mock(log="previous log")
+        test_with_log.name = "test_3"
+        testrun = Mock(log_file=TEST_LOG, log_file_storage=None)
+        testrun.tests.filter.return_value = [test, test_with_log]
+
+        self.plugin.postprocess_testrun(testrun)
+
+        self.assertEqual("test_3: some log 1\rtest_3: some log 2\rtest_3: some log 3", test.log)
+        self.assertEqual("previous log\rtest_3: some log 1\rtest_3: some log 2\rtest_3: some log 3", test_with_log.log)
+        test_model_mock.objects.bulk_update.assert_called_once_with([test, test_with_log], ['log'], batch_size=10)
+
+    def test_read_log_lines(self):
+        expected = TEST_LOG.split("\n")
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            for contents in [TEST_LOG.encode(), gzip.compress(TEST_LOG.encode()), b""]:
+                with open(os.path.join(media_root, "log.txt"), "wb") as f:
+                    f.write(contents)
+                log_file = TestRun(log_file_storage="log.txt").log_file_storage
+                self.assertEqual(expected if contents else [""], list(read_log_lines(log_file)))
+        # storage without a local file
+        log_file = Mock(storage=Mock(open=lambda name, mode: File(BytesIO(TEST_LOG.encode()), name=name)))
+        log_file.name = "log.txt"
+        self.assertEqual(expected, list(read_log_lines(log_file)))
+        self.assertEqual([line.encode() for line in expected], list(iterate_lines(BytesIO(TEST_LOG.encode()), chunk_size=5)))
+
+    @patch("ltp.transaction")
+    @patch("ltp.Test")
+    def test_postprocess_testrun_log_file_storage(self, test_model_mock, transaction_mock):
+        test = Mock(log=None)
+        test.name = "test_1"
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            with open(os.path.join(media_root, "log.txt"), "wb") as f:
+                f.write(TEST_LOG.encode())
+            testrun = TestRun(log_file_storage="log.txt")
+            with patch.object(TestRun, "tests") as tests_mock:
+                tests_mock.filter.return_value = [test]
+                self.plugin.postprocess_testrun(testrun)
+
+            self.assertEqual("test_1: some log 1\rtest_1: some log 2\rtest_1: some log 3", test.log)
+            # the log is still readable by the plugins that run next
+            self.assertEqual(TEST_LOG, testrun.log_file)
+
+    def test_pan_log_parser(self):
+        parser = PanLogParser(["accept01"])
+        self.assertEqual(PAN_LOG.split("\n"), list(parser.scan(PAN_LOG.split("\n"))))
+        self.assertEqual(["abort01", "accept01"], sorted(parser.sections.keys()))
+
+        abort01 = parser.sections["abort01"]
+        self.assertIsNone(abort01.output)
+        self.assertEqual("abort01     1  TPASS  :  Test passed\n", PAN_LOG[abort01.offset:abort01.offset + abort01.length])
+        self.assertEqual(("0", "exited", "0"), (abort01.duration, abort01.termination_type, abort01.termination_id))
+
+        accept01 = parser.sections["accept01"]
+        self.assertEqual(3, len(accept01.output))
+        self.assertEqual("\n".join(accept01.output) + "\n", PAN_LOG[accept01.offset:accept01.offset + accept01.length])
+        self.assertEqual(("2", "exited", "1"), (accept01.duration, accept01.termination_type, accept01.termination_id))
+
+    @patch("ltp.transaction")
+    @patch("ltp.Test")
+    def test_postprocess_testrun_pan_sections(self, test_model_mock, transaction_mock):
+        accept01 = Mock(log=None)
+        accept01.name = "accept01"
+        test_1 = Mock(log=None)
+        test_1.name = "test_1"
+        testrun = Mock(log_file=PAN_LOG + TEST_LOG, log_file_storage=None)
+        testrun.tests.filter.return_value = [accept01, test_1]
+
+        self.plugin.postprocess_testrun(testrun)
+
+        self.assertEqual(
+            "tst_test.c:1106: INFO: Timeout per run is 0h 05m 00s\r"
+            "accept01.c:82: FAIL: bad file descriptor failed unexpectedly\r"
+            "accept01    1  TFAIL  :  bad file descriptor",
+            accept01.log)
+        self.assertEqual("test_1: some log 1\rtest_1: some log 2\rtest_1: some log 3", test_1.log)
+
+    @override_settings(PLUGINS_LTP_ASYNC=True, PLUGINS_LTP_QUEUE="ltp", PLUGINS_LTP_COALESCE_DELAY=5)
+    @patch("ltp.process_build_logs")
+    @patch("ltp.transaction")
+    @patch("ltp.PluginScratch")
+    def test_postprocess_testrun_async(self, plugin_scratch_mock, transaction_mock, process_build_logs_mock):
+        transaction_mock.on_commit.side_effect = lambda callback: callback()
+        testruns = [Mock(pk=pk, build_id=55) for pk in [1, 2]]
+        for testrun in testruns:
+            self.plugin.postprocess_testrun(testrun)
+        ltp.django_cache.delete(ltp.build_task_key(55))
+
+        self.assertEqual(
+            ["ltp-logs:1", "ltp-logs:2"],
+            [call[1]['storage'] for call in plugin_scratch_mock.objects.create.call_args_list])
+        process_build_logs_mock.apply_async.assert_called_once_with((55,), countdown=5 + ltp.COALESCE_COUNTDOWN_MARGIN, queue="ltp")
+        testruns[0].tests.filter.assert_not_called()
+
+    @patch.object(LtpLogs, "_assign_logs")
+    @patch("ltp.TestRun")
+    @patch("ltp.transaction")
+    @patch("ltp.PluginScratch")
+    def test_process_build_logs(self, plugin_scratch_mock, transaction_mock, testrun_mock, assign_logs_mock):
+        queued = plugin_scratch_mock.objects.filter.return_value.exclude.return_value.values_list
+        # scratch 12 was queued while the task was running
+        queued.side_effect = [[10, 11], [12], []]
+        scratch = Mock(storage="ltp-logs:1")
+        late_scratch = Mock(storage="ltp-logs:2")
+        # scratch 11 was already processed by another task
+        plugin_scratch_mock.objects.select_for_update.return_value.filter.return_value.first.side_effect = [scratch, None, late_scratch]
+
+        ltp.process_build_logs(55)
+
+        plugin_scratch_mock.objects.filter.assert_any_call(build_id=55, storage__startswith="ltp-logs:")
+        self.assertEqual([10, 11], sorted(plugin_scratch_mock.objects.filter.return_value.exclude.call_args_list[1][1]['pk__in']))
+        self.assertEqual([((), {'pk': 1}), ((), {'pk': 2})], testrun_mock.objects.filter.call_args_list)
+        self.assertEqual(2, assign_logs_mock.call_count)
+        scratch.delete.assert_called_once_with()
+        late_scratch.delete.assert_called_once_with()
+
+    @patch.object(LtpLogs, "_assign_logs")
+    @patch("ltp.TestRun")
+    @patch("ltp.transaction")
+    @patch("ltp.PluginScratch")
+    def test_process_build_logs_error(self, plugin_scratch_mock, transaction_mock, testrun_mock, assign_logs_mock):
+        plugin_scratch_mock.objects.filter.return_value.exclude.return_value.values_list.side_effect = [[10, 11], []]
+        first_scratch = Mock(storage="ltp-logs:1")
+        second_scratch = Mock(storage="ltp-logs:2")
+        plugin_scratch_mock.objects.select_for_update.return_value.filter.return_value.first.side_effect = [first_scratch, second_scratch]
+        assign_logs_mock.side_effect = [UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid start byte'), None]
+
+        with self.assertRaises(Retry):
+            ltp.process_build_logs(55)
+
+        # the failing testrun doesn't stop the others
+        self.assertEqual(2, assign_logs_mock.call_count)
+        first_scratch.delete.assert_not_called()
+        second_scratch.delete.assert_called_once_with()
+
+    @patch.object(LtpLogs, "_assign_logs")
+    @patch("ltp.TestRun")
+    @patch("ltp.transaction")
+    @patch("ltp.PluginScratch")
+    def test_process_build_logs_give_up(self, plugin_scratch_mock, transaction_mock, testrun_mock, assign_logs_mock):
+        plugin_scratch_mock.objects.filter.return_value.exclude.return_value.values_list.side_effect = [[10], []]
+        plugin_scratch_mock.objects.select_for_update.return_value.filter.return_value.first.return_value = Mock(storage="ltp-logs:1")
+        assign_logs_mock.side_effect = ValueError("broken log")
+
+        ltp.process_build_logs.push_request(retries=ltp.process_build_logs.max_retries)
+        try:
+            ltp.process_build_logs.run(55)
+        finally:
+            ltp.process_build_logs.pop_request()
+
+        plugin_scratch_mock.objects.filter.assert_called_with(pk__in={10})
+        plugin_scratch_mock.objects.filter.return_value.delete.assert_called_once_with()
 
 
 if __name__ == "__main__":
@@ -6,12 +6,19 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'squad.settings'
 django.setup()
 
 
+import hashlib
 import logging
+import requests
 import tarfile
+import tempfile
 import unittest
 import tradefed
+import xmlrpc.client
+import yaml
 from io import StringIO, BytesIO
 from unittest.mock import PropertyMock, MagicMock, Mock, patch
+from celery.exceptions import Retry
+from django.test import override_settings
 from tradefed import Tradefed, ResultFiles, ExtractedResult
 
 
@@ -541,17 +548,102 @@ class TradefedLogsPluginTest(unittest.TestCase):
             result_files.test_results,
             'application/xml')
 
+    @override_settings(PLUGINS_TRADEFED_FETCH_WORKERS=2)
+    @patch("tradefed.Tradefed._process_results")
+    @patch("tradefed.Tradefed._get_from_artifactorial")
+    def test_postprocess_testjob_concurrent_fetch(self, get_from_artifactorial_mock, process_results_mock):
+        job_definition = yaml.safe_load(JOB_DEFINITION)
+        cts_definition = job_definition['actions'][-1]['test']['definitions'][0]
+        vts_definition = dict(cts_definition, name="vts-lkft-arm64-v8a")
+        job_definition['actions'][-1]['test']['definitions'].append(vts_definition)
+        results = {}
+        for name in ["cts-lkft-armeabi-v7a", "vts-lkft-arm64-v8a"]:
+            results[name] = ResultFiles()
+            results[name].tradefed_results_url = "http://foo.com/%s" % name
+        get_from_artifactorial_mock.side_effect = lambda testjob, name: results[name]
+        testjob_mock = MagicMock()
+        testjob_mock.backend.implementation_type = "lava"
+        testjob_mock.definition = yaml.dump(job_definition)
+        self.plugin.postprocess_testjob(testjob_mock)
+        self.assertEqual(2, get_from_artifactorial_mock.call_count)
+        self.assertEqual(
+            [(testjob_mock, cts_definition, results["cts-lkft-armeabi-v7a"]),
+             (testjob_mock, vts_definition, results["vts-lkft-arm64-v8a"])],
+            [c[0] for c in process_results_mock.call_args_list])
+
+    def test_replace_in_stream(self):
+        replacements = {b"logo.png": b"http://foo/logo.png", b"compatibility_result.css": b"http://foo/compatibility_result.css"}
+        source = b"<img src='logo.png'/><link href='compatibility_result.css'/>logo.pn" * 50
+        expected = source.replace(b"compatibility_result.css", b"http://foo/compatibility_result.css").replace(b"'logo.png", b"'http://foo/logo.png")
+        for chunk_size in [1, 3, 7, 24, 1024]:
+            destination = BytesIO()
+            length = tradefed.replace_in_stream(BytesIO(source), destination, replacements, chunk_size=chunk_size)
+            self.assertEqual(expected, destination.getvalue())
+            self.assertEqual(len(expected), length)
+
+    def test_convert_paths(self):
+        testrun = Mock()
+        testrun.id = 3
+        testrun.build.version = "v1"
+        testrun.build.project.slug = "project"
+        testrun.build.project.group.slug = "group"
+        results = ResultFiles()
+        results.test_results = ExtractedResult()
+        results.test_results.contents = BytesIO(b'<?xml-stylesheet type="text/xsl" href="compatibility_result.xsl"?>')
+        results.test_result_xslt = ExtractedResult()
+        results.test_result_xslt.contents = BytesIO(b'<link href="compatibility_result.css"/><img src="logo.png"/>')
+        with override_settings(BASE_URL="http://squad"):
+            self.plugin._convert_paths(testrun, results)
+        url = b"http://squad/group/project/build/v1/attachments/testrun/3/"
+        test_results = b'<?xml-stylesheet type="text/xsl" href="' + url + b'compatibility_result.xsl"?>'
+        self.assertEqual(test_results, results.test_results.contents.read())
+        self.assertEqual(len(test_results), results.test_results.length)
+        test_result_xslt = b'<link href="' + url + b'compatibility_result.css"/><img src="' + url + b'logo.png"/>'
+        self.assertEqual(test_result_xslt, results.test_result_xslt.contents.read())
+        self.assertEqual(len(test_result_xslt), results.test_result_xslt.length)
+
+    def test_convert_paths_attachment_streamed(self):
+        testrun = Mock()
+        testrun.id = 3
+        testrun.attachments.create.return_value.id = 44
+        results = ResultFiles()
+        results.test_results = ExtractedResult()
+        results.test_results.contents = BytesIO(b'<?xml-stylesheet type="text/xsl" href="compatibility_result.xsl"?>')
+        with override_settings(BASE_URL="http://squad"):
+            self.plugin._convert_paths(testrun, results)
+        converted = results.test_results.contents
+        self.plugin._create_testrun_attachment(testrun, "test_results.xml", results.test_results, "application/xml")
+        stored_file = testrun.attachments.create.return_value.storage.save.call_args[0][1]
+        self.assertIs(converted, stored_file.file)
+        self.assertIn(b'/attachments/testrun/3/compatibility_result.xsl', stored_file.read())
+
     def test_create_testrun_attachment(self):
         testrun_mock = Mock()
+        testrun_mock.attachments.create.return_value.id = 44
         name = "name"
-        extracted_file_mock = Mock()
-        type(extracted_file_mock).length = PropertyMock(return_value=2)
-        content_mock = Mock()
-        #read_mock = Mock()
-        type(content_mock).read = lambda s: 'abc'
-        type(extracted_file_mock).contents = content_mock
-        self.plugin._create_testrun_attachment(testrun_mock, name, extracted_file_mock, "text/plain")
-        testrun_mock.attachments.create.assert_called_with(old_data='abc', filename='name', length=2, mimetype='text/plain')
+        contents = BytesIO(b'abc')
+        contents.read = Mock(side_effect=AssertionError("attachment read into memory"))
+        extracted_file = ExtractedResult()
+        extracted_file.contents = contents
+        extracted_file.length = 3
+        self.plugin._create_testrun_attachment(testrun_mock, name, extracted_file, "text/plain")
+        testrun_mock.attachments.create.assert_called_with(filename='name', length=3, mimetype='text/plain')
+        storage_save = testrun_mock.attachments.create.return_value.storage.save
+        path, stored_file = storage_save.call_args[0]
+        self.assertEqual('attachment/44/name', path)
+        self.assertIs(contents, stored_file.file)
+
+    @patch("tradefed.attachment_has_old_data")
+    def test_create_testrun_attachment_old_data(self, attachment_has_old_data_mock):
+        attachment_has_old_data_mock.return_value = True
+        testrun_mock = Mock()
+        extracted_file = ExtractedResult()
+        extracted_file.contents = BytesIO(b'abc')
+        extracted_file.length = 3
+        self.plugin._create_testrun_attachment(testrun_mock, "name", extracted_file, "text/plain")
+        testrun_mock.attachments.create.assert_called_with(old_data=b'abc', filename='name', length=3, mimetype='text/plain')
+        stored_file = testrun_mock.attachments.create.return_value.storage.save.call_args[0][1]
+        self.assertEqual(0, stored_file.tell())
 
     @patch("tradefed.Tradefed._download_results")
     def test_get_from_artifactorial(self, download_results_mock):
@@ -564,6 +656,10 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.return_value = (
             RESULTS
         )
+        testjob_mock.backend.get_implementation().proxy.results.get_testcase_results_yaml.side_effect = (
+            xmlrpc.client.Fault(1, "method not supported")
+        )
+        testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_count.return_value = 2
         job_id_mock = PropertyMock(return_value=999)
         type(testjob_mock).job_id = job_id_mock
         result = self.plugin._get_from_artifactorial(testjob_mock, suite_name)
@@ -572,6 +668,54 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.assert_called_with(999, '2_bar', 500, 0)
         self.assertIsNotNone(result)
 
+    @patch("tradefed.Tradefed._download_results")
+    def test_get_from_artifactorial_testcase_lookup(self, download_results_mock):
+        download_results_mock.return_value = ResultFiles()
+        testjob_mock = Mock()
+        proxy = testjob_mock.backend.get_implementation().proxy
+        proxy.results.get_testjob_suites_list_yaml.return_value = SUITES
+        proxy.results.get_testcase_results_yaml.return_value = RESULTS
+        testjob_mock.job_id = 999
+        result = self.plugin._get_from_artifactorial(testjob_mock, "2_bar")
+        self.assertIsNotNone(result)
+        proxy.results.get_testcase_results_yaml.assert_called_once_with(999, '2_bar', 'test-attachment')
+        proxy.results.get_testsuite_results_yaml.assert_not_called()
+        self.assertEqual('test-attachment', download_results_mock.call_args[0][0]['name'])
+
+    @patch("tradefed.Tradefed._download_results")
+    def test_get_from_artifactorial_testcase_not_found(self, download_results_mock):
+        testjob_mock = Mock()
+        proxy = testjob_mock.backend.get_implementation().proxy
+        proxy.results.get_testjob_suites_list_yaml.return_value = SUITES
+        proxy.results.get_testcase_results_yaml.side_effect = xmlrpc.client.Fault(404, "Specified test case not found")
+        testjob_mock.job_id = 999
+        result = self.plugin._get_from_artifactorial(testjob_mock, "2_bar")
+        self.assertIsNone(result)
+        proxy.results.get_testsuite_results_yaml.assert_not_called()
+        download_results_mock.assert_not_called()
+
+    @patch("tradefed.Tradefed._download_results")
+    def test_get_from_artifactorial_search_from_end(self, download_results_mock):
+        download_results_mock.return_value = ResultFiles()
+        testjob_mock = Mock()
+        proxy = testjob_mock.backend.get_implementation().proxy
+        proxy.results.get_testjob_suites_list_yaml.return_value = SUITES
+        proxy.results.get_testcase_results_yaml.side_effect = xmlrpc.client.Fault(1, "method not supported")
+        proxy.results.get_testsuite_results_count.return_value = 2000
+        other_result = "- {name: foo, metadata: {}}\n"
+        attachment_result = "- {name: test-attachment, metadata: {reference: 'http://foo.bar.com'}}\n"
+        proxy.results.get_testsuite_results_yaml.side_effect = [
+            other_result * 500,
+            attachment_result + other_result * 999,
+        ]
+        testjob_mock.job_id = 999
+        result = self.plugin._get_from_artifactorial(testjob_mock, "2_bar")
+        self.assertIsNotNone(result)
+        self.assertEqual(2, proxy.results.get_testsuite_results_yaml.call_count)
+        proxy.results.get_testsuite_results_yaml.assert_any_call(999, '2_bar', 500, 1500)
+        proxy.results.get_testsuite_results_yaml.assert_called_with(999, '2_bar', 1000, 500)
+        download_results_mock.assert_called_once_with({'name': 'test-attachment', 'metadata': {'reference': RESULT_URL}})
+
     @patch("tradefed.Tradefed._download_results")
     def test_get_from_artifactorial_invalid_suite_list(self, download_results_mock):
         suite_name = "2_bar"
@@ -621,6 +765,10 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.return_value = (
             RESULTS_INVALID
         )
+        testjob_mock.backend.get_implementation().proxy.results.get_testcase_results_yaml.side_effect = (
+            xmlrpc.client.Fault(1, "method not supported")
+        )
+        testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_count.return_value = 2
         job_id_mock = PropertyMock(return_value=999)
         type(testjob_mock).job_id = job_id_mock
         result = self.plugin._get_from_artifactorial(testjob_mock, suite_name)
@@ -640,6 +788,10 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.return_value = (
             "[]"
         )
+        testjob_mock.backend.get_implementation().proxy.results.get_testcase_results_yaml.side_effect = (
+            xmlrpc.client.Fault(1, "method not supported")
+        )
+        testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_count.return_value = 2
         job_id_mock = PropertyMock(return_value=999)
         type(testjob_mock).job_id = job_id_mock
         result = self.plugin._get_from_artifactorial(testjob_mock, suite_name)
@@ -648,13 +800,12 @@ class TradefedLogsPluginTest(unittest.TestCase):
         testjob_mock.backend.get_implementation().proxy.results.get_testsuite_results_yaml.assert_called_with(999, '2_bar', 500, 0)
         self.assertIsNone(result)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_download_results(self, get_mock):
         requests_result_mock = Mock()
         status_code_mock = PropertyMock(return_value=200)
         type(requests_result_mock).status_code = status_code_mock
-        content_mock = PropertyMock(return_value=self.tarfile.read())
-        type(requests_result_mock).content = content_mock
+        requests_result_mock.iter_content.return_value = [self.tarfile.read()]
         url_mock = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
         type(requests_result_mock).url = url_mock
         headers_mock = PropertyMock(return_value={"Content-Type": "application/x-tar"})
@@ -662,20 +813,182 @@ class TradefedLogsPluginTest(unittest.TestCase):
         get_mock.return_value = requests_result_mock
         results = self.plugin._download_results(RESULT_DICT)
         status_code_mock.assert_called_once_with()
-        self.assertEqual(content_mock.call_count, 2)
+        get_mock.assert_called_once_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={})
+        requests_result_mock.iter_content.assert_called_once_with(chunk_size=tradefed.DOWNLOAD_CHUNK_SIZE)
         self.assertEqual(self.plugin.tradefed_results_url, RESULT_URL)
         self.assertIsNotNone(results.test_results)
         self.assertIsNotNone(results.tradefed_stdout)
         self.assertIsNotNone(results.tradefed_logcat)
 
-    @patch("tarfile.TarFile.getmembers")
-    @patch("requests.get")
+    @override_settings(PLUGINS_TRADEFED_SPOOL_MAX_SIZE=1024)
+    @patch("requests.Session.get")
+    def test_download_results_spooled_to_disk(self, get_mock):
+        requests_result_mock = Mock()
+        type(requests_result_mock).status_code = PropertyMock(return_value=200)
+        tarball = self.tarfile.read()
+        chunks = [tarball[i:i + 512] for i in range(0, len(tarball), 512)]
+        requests_result_mock.iter_content.return_value = chunks
+        type(requests_result_mock).url = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
+        type(requests_result_mock).headers = PropertyMock(return_value={"Content-Type": "application/x-tar"})
+        get_mock.return_value = requests_result_mock
+        results = self.plugin._download_results(RESULT_DICT)
+        self.assertEqual(len(tarball), results.tradefed_zipfile.length)
+        self.assertTrue(results.tradefed_zipfile.contents._rolled)
+        self.assertIsNotNone(results.test_results)
+        self.assertIsNotNone(results.tradefed_stdout)
+        self.assertIsNotNone(results.tradefed_logcat)
+
+    @patch("requests.Session.get")
+    def test_download_results_member_contents(self, get_mock):
+        requests_result_mock = Mock()
+        type(requests_result_mock).status_code = PropertyMock(return_value=200)
+        tarball = self.tarfile.read()
+        requests_result_mock.iter_content.return_value = [tarball[:1000], tarball[1000:]]
+        type(requests_result_mock).url = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
+        type(requests_result_mock).headers = PropertyMock(return_value={"Content-Type": "application/x-tar"})
+        get_mock.return_value = requests_result_mock
+        results = self.plugin._download_results(RESULT_DICT)
+        self.assertEqual(tarball, results.tradefed_zipfile.contents.read())
+        with tarfile.open(self.tarfile_path, mode='r:xz') as t:
+            for member in t.getmembers():
+                if "test_result.xml" in member.name:
+                    self.assertEqual(t.extractfile(member).read(), results.test_results.contents.read())
+                    self.assertEqual(member.size, results.test_results.length)
+
+    @patch("requests.Session.get")
+    def test_download_results_cached(self, get_mock):
+        tarball = self.tarfile.read()
+        first_response = Mock()
+        first_response.status_code = 200
+        first_response.iter_content.return_value = [tarball]
+        first_response.url = "http://foo.bar.com/file.tar.xz"
+        first_response.headers = {"Content-Type": "application/x-tar", "ETag": '"abc"'}
+        second_response = Mock()
+        second_response.status_code = 304
+        get_mock.side_effect = [first_response, second_response]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir):
+                self.plugin._download_results(RESULT_DICT)
+                results = self.plugin._download_results(RESULT_DICT)
+                get_mock.assert_called_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={"If-None-Match": '"abc"'})
+                second_response.iter_content.assert_not_called()
+                self.assertEqual(tarball, results.tradefed_zipfile.contents.read())
+                results.tradefed_zipfile.contents.close()
+                self.assertEqual(len(tarball), results.tradefed_zipfile.length)
+                self.assertEqual("file.tar.xz", results.tradefed_zipfile.name)
+                self.assertIsNotNone(results.test_results)
+                self.assertIsNotNone(results.tradefed_stdout)
+                self.assertIsNotNone(results.tradefed_logcat)
+
+    def tarball_response(self):
+        response = Mock()
+        response.status_code = 200
+        response.iter_content.return_value = [self.tarfile.read()]
+        self.tarfile.seek(0)
+        response.url = "http://foo.bar.com/file.tar.xz"
+        response.headers = {"Content-Type": "application/x-tar"}
+        return response
+
+    @patch("requests.Session.get")
+    def test_download_results_cache_dir_error(self, get_mock):
+        get_mock.return_value = self.tarball_response()
+        with tempfile.NamedTemporaryFile() as not_a_dir:
+            with override_settings(PLUGINS_TRADEFED_CACHE_DIR=os.path.join(not_a_dir.name, "cache")):
+                results = self.plugin._download_results(RESULT_DICT)
+        self.assertIsNotNone(results.test_results)
+
+    @patch.object(tradefed.TarballCache, "new_file", side_effect=OSError("disk full"))
+    @patch("requests.Session.get")
+    def test_download_results_cache_new_file_error(self, get_mock, new_file_mock):
+        get_mock.return_value = self.tarball_response()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir):
+                results = self.plugin._download_results(RESULT_DICT)
+        self.assertIsNotNone(results.test_results)
+
+    @patch("requests.Session.get")
+    def test_download_results_cache_write_error(self, get_mock):
+        get_mock.side_effect = [self.tarball_response(), self.tarball_response()]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir):
+                read_only = os.path.join(cache_dir, "read-only")
+                open(read_only, "w").close()
+                with patch.object(tradefed.TarballCache, "new_file", side_effect=lambda: open(read_only, "rb")):
+                    results = self.plugin._download_results(RESULT_DICT)
+                # downloaded again without the cache
+                self.assertEqual(2, get_mock.call_count)
+                self.assertFalse(os.path.exists(read_only))
+                self.assertIsNotNone(results.test_results)
+
+    @patch.object(tradefed.TarballCache, "open", return_value=None)
+    @patch("requests.Session.get")
+    def test_download_results_cache_evicted(self, get_mock, open_mock):
+        first_response = self.tarball_response()
+        first_response.headers = {"Content-Type": "application/x-tar", "ETag": '"abc"'}
+        get_mock.side_effect = [first_response, self.tarball_response()]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(PLUGINS_TRADEFED_CACHE_DIR=cache_dir):
+                self.plugin._download_results(RESULT_DICT)
+                results = self.plugin._download_results(RESULT_DICT)
+        # evicted by another worker, so no conditional request
+        open_mock.assert_called_once()
+        get_mock.assert_called_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={})
+        self.assertIsNotNone(results.test_results)
+
+    def test_tarball_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = tradefed.TarballCache(cache_dir, 10)
+            for url, data in [("http://foo/1", b"123456"), ("http://foo/2", b"abcdef")]:
+                new_file = cache.new_file()
+                new_file.write(data)
+                digest = hashlib.sha256(data).hexdigest()
+                cache.put(url, new_file, {'sha256': digest, 'etag': url})
+                new_file.close()
+                # make the first file the least recently used one
+                os.utime(os.path.join(cache_dir, 'data', digest), (0, 0))
+            self.assertIsNone(cache.get("http://foo/1"))
+            # index of the evicted file is removed too
+            self.assertEqual(1, len(os.listdir(os.path.join(cache_dir, 'index'))))
+            self.assertEqual("http://foo/2", cache.get("http://foo/2")['etag'])
+            self.assertEqual({"If-None-Match": "http://foo/2"}, cache.validators(cache.get("http://foo/2")))
+
+    def test_tarball_cache_put_error(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = tradefed.TarballCache(cache_dir, 1024)
+            new_file = cache.new_file()
+            new_file.write(b"123456")
+            with patch("os.replace", side_effect=OSError("disk full")):
+                cache.put("http://foo/1", new_file, {'sha256': "0" * 64})
+            # temporary file is removed but still readable
+            self.assertEqual([], os.listdir(os.path.join(cache_dir, 'data')))
+            new_file.seek(0)
+            self.assertEqual(b"123456", new_file.read())
+            new_file.close()
+            self.assertIsNone(cache.get("http://foo/1"))
+
+    def test_tarball_cache_eviction_stale_tmp(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = tradefed.TarballCache(cache_dir, 1024)
+            stale_file = cache.new_file()
+            stale_file.close()
+            os.utime(stale_file.name, (0, 0))
+            stale_index = os.path.join(cache_dir, 'index', '.tmpfoo')
+            open(stale_index, 'w').close()
+            os.utime(stale_index, (0, 0))
+            recent_file = cache.new_file()
+            recent_file.close()
+            cache.evict()
+            self.assertFalse(os.path.exists(stale_file.name))
+            self.assertFalse(os.path.exists(stale_index))
+            self.assertTrue(os.path.exists(recent_file.name))
+
+    @patch("tarfile.TarFile.next")
+    @patch("requests.Session.get")
     def test_download_results_short_file(self, get_mock, tarfile_mock):
         requests_result_mock = Mock()
         status_code_mock = PropertyMock(return_value=200)
         type(requests_result_mock).status_code = status_code_mock
-        content_mock = PropertyMock(return_value=self.tarfile.read())
-        type(requests_result_mock).content = content_mock
+        requests_result_mock.iter_content.return_value = [self.tarfile.read()]
         url_mock = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
         type(requests_result_mock).url = url_mock
         headers_mock = PropertyMock(return_value={"Content-Type": "application/x-tar"})
@@ -684,20 +997,20 @@ class TradefedLogsPluginTest(unittest.TestCase):
         tarfile_mock.side_effect = EOFError()
         results = self.plugin._download_results(RESULT_DICT)
         status_code_mock.assert_called_once_with()
-        self.assertEqual(content_mock.call_count, 2)
+        get_mock.assert_called_once_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={})
+        requests_result_mock.iter_content.assert_called_once_with(chunk_size=tradefed.DOWNLOAD_CHUNK_SIZE)
         self.assertEqual(self.plugin.tradefed_results_url, RESULT_URL)
         self.assertIsNone(results.test_results)
         self.assertIsNone(results.tradefed_stdout)
         self.assertIsNone(results.tradefed_logcat)
 
-    @patch("tarfile.TarFile.getmembers")
-    @patch("requests.get")
+    @patch("tarfile.TarFile.next")
+    @patch("requests.Session.get")
     def test_download_results_corrupted_compression_readerror(self, get_mock, tarfile_mock):
         requests_result_mock = Mock()
         status_code_mock = PropertyMock(return_value=200)
         type(requests_result_mock).status_code = status_code_mock
-        content_mock = PropertyMock(return_value=self.tarfile.read())
-        type(requests_result_mock).content = content_mock
+        requests_result_mock.iter_content.return_value = [self.tarfile.read()]
         url_mock = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
         type(requests_result_mock).url = url_mock
         headers_mock = PropertyMock(return_value={"Content-Type": "application/x-tar"})
@@ -706,20 +1019,20 @@ class TradefedLogsPluginTest(unittest.TestCase):
         tarfile_mock.side_effect = tarfile.ReadError()
         results = self.plugin._download_results(RESULT_DICT)
         status_code_mock.assert_called_once_with()
-        self.assertEqual(content_mock.call_count, 2)
+        get_mock.assert_called_once_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={})
+        requests_result_mock.iter_content.assert_called_once_with(chunk_size=tradefed.DOWNLOAD_CHUNK_SIZE)
         self.assertEqual(self.plugin.tradefed_results_url, RESULT_URL)
         self.assertIsNone(results.test_results)
         self.assertIsNone(results.tradefed_stdout)
         self.assertIsNone(results.tradefed_logcat)
 
-    @patch("tarfile.TarFile.getmembers")
-    @patch("requests.get")
+    @patch("tarfile.TarFile.next")
+    @patch("requests.Session.get")
     def test_download_results_corrupted_compression_headererror(self, get_mock, tarfile_mock):
         requests_result_mock = Mock()
         status_code_mock = PropertyMock(return_value=200)
         type(requests_result_mock).status_code = status_code_mock
-        content_mock = PropertyMock(return_value=self.tarfile.read())
-        type(requests_result_mock).content = content_mock
+        requests_result_mock.iter_content.return_value = [self.tarfile.read()]
         url_mock = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
         type(requests_result_mock).url = url_mock
         headers_mock = PropertyMock(return_value={"Content-Type": "application/x-tar"})
@@ -728,19 +1041,19 @@ class TradefedLogsPluginTest(unittest.TestCase):
         tarfile_mock.side_effect = tarfile.HeaderError()
         results = self.plugin._download_results(RESULT_DICT)
         status_code_mock.assert_called_once_with()
-        self.assertEqual(content_mock.call_count, 2)
+        get_mock.assert_called_once_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={})
+        requests_result_mock.iter_content.assert_called_once_with(chunk_size=tradefed.DOWNLOAD_CHUNK_SIZE)
         self.assertEqual(self.plugin.tradefed_results_url, RESULT_URL)
         self.assertIsNone(results.test_results)
         self.assertIsNone(results.tradefed_stdout)
         self.assertIsNone(results.tradefed_logcat)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_download_results_no_tarball(self, get_mock):
         requests_result_mock = Mock()
         status_code_mock = PropertyMock(return_value=200)
         type(requests_result_mock).status_code = status_code_mock
-        content_mock = PropertyMock(return_value=bytes())
-        type(requests_result_mock).content = content_mock
+        requests_result_mock.iter_content.return_value = [bytes()]
         url_mock = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
         type(requests_result_mock).url = url_mock
         headers_mock = PropertyMock(return_value={"Content-Type": "application/x-tar"})
@@ -748,19 +1061,19 @@ class TradefedLogsPluginTest(unittest.TestCase):
         get_mock.return_value = requests_result_mock
         results = self.plugin._download_results(RESULT_DICT)
         status_code_mock.assert_called_once_with()
-        self.assertEqual(content_mock.call_count, 2)
+        get_mock.assert_called_once_with(RESULT_URL, stream=True, timeout=tradefed.get_http_timeout(), headers={})
+        requests_result_mock.iter_content.assert_called_once_with(chunk_size=tradefed.DOWNLOAD_CHUNK_SIZE)
         self.assertEqual(self.plugin.tradefed_results_url, RESULT_URL)
         self.assertIsNone(results.test_results)
         self.assertIsNone(results.tradefed_stdout)
         self.assertIsNone(results.tradefed_logcat)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     def test_download_results_expired_url(self, get_mock):
         requests_result_mock = Mock()
         status_code_mock = PropertyMock(return_value=404)
         type(requests_result_mock).status_code = status_code_mock
-        content_mock = PropertyMock(return_value=bytes())
-        type(requests_result_mock).content = content_mock
+        requests_result_mock.iter_content.return_value = [bytes()]
         url_mock = PropertyMock(return_value="http://foo.bar.com/file.tar.xz")
         type(requests_result_mock).url = url_mock
         headers_mock = PropertyMock(return_value={"Content-Type": "application/x-tar"})
@@ -768,69 +1081,648 @@ class TradefedLogsPluginTest(unittest.TestCase):
         get_mock.return_value = requests_result_mock
         results = self.plugin._download_results(RESULT_DICT)
         status_code_mock.assert_called_once_with()
-        content_mock.assert_not_called()
+        requests_result_mock.iter_content.assert_not_called()
         self.assertEqual(self.plugin.tradefed_results_url, RESULT_URL)
         self.assertIsNone(results.test_results)
         self.assertIsNone(results.tradefed_stdout)
         self.assertIsNone(results.tradefed_logcat)
 
-    def test_assign_test_log(self):
+    @patch("requests.Session.get")
+    def test_download_results_connection_dropped(self, get_mock):
+        requests_result_mock = Mock()
+        requests_result_mock.status_code = 200
+        requests_result_mock.url = "http://foo.bar.com/file.tar.xz"
+        requests_result_mock.headers = {"Content-Type": "application/x-tar"}
+
+        def iter_content(chunk_size):
+            yield b'\xfd7zXZ'
+            raise requests.exceptions.ConnectionError("Read timed out.")
+
+        requests_result_mock.iter_content.side_effect = iter_content
+        get_mock.return_value = requests_result_mock
+        results = self.plugin._download_results(RESULT_DICT)
+        self.assertEqual(RESULT_URL, results.tradefed_results_url)
+        self.assertIsNone(results.tradefed_zipfile)
+        self.assertIsNone(results.test_results)
+        requests_result_mock.close.assert_called_once_with()
+
+    def test_get_http_session(self):
+        session = tradefed.get_http_session(1, {"Authorization": "Token foo"})
+        self.assertIs(session, tradefed.get_http_session(1, {"Authorization": "Token foo"}))
+        self.assertIsNot(session, tradefed.get_http_session(2, {"Authorization": "Token foo"}))
+        self.assertIsNot(session, tradefed.get_http_session())
+        self.assertEqual("Token foo", session.headers["Authorization"])
+        self.assertNotIn("Authorization", tradefed.get_http_session().headers)
+
+    @override_settings(PLUGINS_TRADEFED_HTTP_POOL_SIZE=3)
+    def test_get_http_session_pool_size(self):
+        session = tradefed.get_http_session("pool-size-test")
+        adapter = session.get_adapter("https://lava.example.com/")
+        self.assertEqual(3, adapter._pool_connections)
+        self.assertEqual(3, adapter._pool_maxsize)
+
+    @override_settings(PLUGINS_TRADEFED_HTTP_CONNECT_TIMEOUT=1, PLUGINS_TRADEFED_HTTP_READ_TIMEOUT=2)
+    def test_get_http_timeout(self):
+        self.assertEqual((1, 2), tradefed.get_http_timeout())
+
+    @patch("tradefed.Tradefed._download_results")
+    @patch("requests.Session.get")
+    def test_get_from_artifactorial_rest(self, get_mock, download_results_mock):
+        download_results_mock.return_value = ResultFiles()
+        suites_response = Mock()
+        suites_response.status_code = 200
+        suites_response.json.return_value = {"results": [{"id": 1, "name": "2_bar"}], "next": None}
+        attachment_response = Mock()
+        attachment_response.status_code = 200
+        attachment_response.json.return_value = {"results": [{"metadata": "{reference: %s}" % RESULT_URL}]}
+        get_mock.side_effect = [suites_response, attachment_response]
+        testjob_mock = Mock()
+        testjob_mock.job_id = 999
+        testjob_mock.backend.pk = 1
+        testjob_mock.backend.get_implementation().use_xml_rpc = False
+        testjob_mock.backend.get_implementation().api_url_base = "https://lava.example.com/api/v0.2/"
+        testjob_mock.backend.get_implementation().authentication = {"Authorization": "Token foo"}
+        result = self.plugin._get_from_artifactorial(testjob_mock, "2_bar")
+        self.assertIsNotNone(result)
+        get_mock.assert_called_with(
+            "https://lava.example.com/api/v0.2/jobs/999/suites/1/tests/?name=test-attachment",
+            timeout=tradefed.get_http_timeout())
+        download_results_mock.assert_called_once_with({"metadata": {"reference": RESULT_URL}})
+
+    @patch("tradefed.Tradefed._download_results")
+    @patch("requests.Session.get")
+    def test_get_from_artifactorial_rest_pages(self, get_mock, download_results_mock):
+        download_results_mock.return_value = ResultFiles()
+        first_page = Mock()
+        first_page.status_code = 200
+        first_page.json.return_value = {"results": [{"id": 1, "name": "1_foo"}], "next": "https://lava.example.com/page2"}
+        second_page = Mock()
+        second_page.status_code = 200
+        second_page.json.return_value = {"results": [{"id": 2, "name": "2_bar"}], "next": "https://lava.example.com/page3"}
+        third_page = Mock()
+        third_page.status_code = 404
+        attachment_response = Mock()
+        attachment_response.status_code = 200
+        attachment_response.json.return_value = {"results": [{"metadata": "{reference: %s}" % RESULT_URL}]}
+        responses = {
+            "https://lava.example.com/api/v0.2/jobs/999/suites/?name__contains=2_bar": first_page,
+            "https://lava.example.com/page2": second_page,
+            "https://lava.example.com/page3": third_page,
+            "https://lava.example.com/api/v0.2/jobs/999/suites/2/tests/?name=test-attachment": attachment_response,
+        }
+        get_mock.side_effect = lambda url, **kwargs: responses[url]
+        testjob_mock = Mock()
+        testjob_mock.job_id = 999
+        testjob_mock.backend.pk = 1
+        testjob_mock.backend.get_implementation().use_xml_rpc = False
+        testjob_mock.backend.get_implementation().api_url_base = "https://lava.example.com/api/v0.2/"
+        testjob_mock.backend.get_implementation().authentication = {"Authorization": "Token foo"}
+        result = self.plugin._get_from_artifactorial(testjob_mock, "2_bar")
+        self.assertIsNotNone(result)
+        download_results_mock.assert_called_once_with({"metadata": {"reference": RESULT_URL}})
+        first_page.json.assert_called_once_with()
+        second_page.json.assert_called_once_with()
+        # the suite was found before the last page had to be read
+        third_page.json.assert_not_called()
+
+    @patch("tradefed.Tradefed._download_results")
+    @patch.object(requests.Session, "get", autospec=True)
+    def test_get_from_artifactorial_rest_prefetch_session(self, get_mock, download_results_mock):
+        download_results_mock.return_value = ResultFiles()
+        first_page = Mock()
+        first_page.status_code = 200
+        first_page.json.return_value = {"results": [{"id": 1, "name": "1_foo"}], "next": "https://lava.example.com/page2"}
+        second_page = Mock()
+        second_page.status_code = 200
+        second_page.json.return_value = {"results": [{"id": 2, "name": "2_bar"}], "next": None}
+        attachment_response = Mock()
+        attachment_response.status_code = 200
+        attachment_response.json.side_effect = lambda: {"results": [{"metadata": "{reference: %s}" % RESULT_URL}]}
+        responses = {
+            "https://lava.example.com/api/v0.2/jobs/999/suites/?name__contains=2_bar": first_page,
+            "https://lava.example.com/page2": second_page,
+            "https://lava.example.com/api/v0.2/jobs/999/suites/2/tests/?name=test-attachment": attachment_response,
+        }
+        sessions = {}
+
+        def get(session, url, **kwargs):
+            sessions[url] = session
+            return responses[url]
+
+        get_mock.side_effect = get
+        testjob_mock = Mock()
+        testjob_mock.job_id = 999
+        testjob_mock.backend.pk = 1
+        testjob_mock.backend.get_implementation().use_xml_rpc = False
+        testjob_mock.backend.get_implementation().api_url_base = "https://lava.example.com/api/v0.2/"
+        testjob_mock.backend.get_implementation().authentication = {"Authorization": "Token foo"}
+        self.assertIsNotNone(self.plugin._get_from_artifactorial(testjob_mock, "2_bar"))
+        caller_session = sessions["https://lava.example.com/api/v0.2/jobs/999/suites/?name__contains=2_bar"]
+        self.assertIs(caller_session, sessions["https://lava.example.com/api/v0.2/jobs/999/suites/2/tests/?name=test-attachment"])
+        # the prefetch thread doesn't share the caller's session
+        prefetch_session = sessions["https://lava.example.com/page2"]
+        self.assertIsNot(caller_session, prefetch_session)
+        self.assertEqual("Token foo", prefetch_session.headers["Authorization"])
+        # prefetch threads outlive the lookup, so their sessions are reused
+        self.assertIsNotNone(self.plugin._get_from_artifactorial(testjob_mock, "2_bar"))
+        self.assertIs(prefetch_session, sessions["https://lava.example.com/page2"])
+
+    @patch("tradefed.Tradefed._download_results")
+    @patch("requests.Session.get")
+    def test_get_from_artifactorial_rest_page_connection_error(self, get_mock, download_results_mock):
+        first_page = Mock()
+        first_page.status_code = 200
+        first_page.json.return_value = {"results": [{"id": 1, "name": "1_foo"}], "next": "https://lava.example.com/page2"}
+
+        def get(url, **kwargs):
+            if url == "https://lava.example.com/page2":
+                raise requests.exceptions.ConnectionError("Read timed out.")
+            return first_page
+
+        get_mock.side_effect = get
+        testjob_mock = Mock()
+        testjob_mock.job_id = 999
+        testjob_mock.backend.pk = 1
+        testjob_mock.backend.get_implementation().use_xml_rpc = False
+        testjob_mock.backend.get_implementation().api_url_base = "https://lava.example.com/api/v0.2/"
+        testjob_mock.backend.get_implementation().authentication = {"Authorization": "Token foo"}
+        self.assertIsNone(self.plugin._get_from_artifactorial(testjob_mock, "2_bar"))
+        download_results_mock.assert_not_called()
+
+    @patch("tradefed.celery_chord")
+    @patch("tradefed.PluginScratch")
+    @patch("tradefed.get_suites")
+    @patch("tradefed.KnownIssue")
+    def test_extract_cts_results(self, known_issue_mock, get_suites_mock, plugin_scratch_mock, chord_mock):
+        known_issue = Mock(pk=7, test_name="cts-lkft/arm64-v8a.module_foo/TestCaseBar.test_bar4")
+        other_known_issue = Mock(pk=8, test_name="cts-lkft/arm64-v8a.module_bar/TestCaseBar.test_bar4")
+        known_issue_mock.active_by_environment.return_value = [known_issue, other_known_issue]
+        suite = Mock()
+        suite.pk = 11
+        get_suites_mock.return_value = {"cts-lkft/arm64-v8a.module_foo": suite}
+        plugin_scratch_mock.objects.create.return_value.pk = 22
+        testrun = Mock()
+        testrun.pk = 33
+        self.plugin._extract_cts_results(BytesIO(XML_RESULTS.encode('utf-8')), testrun, "cts-lkft")
+        get_suites_mock.assert_called_once_with(testrun.build.project, ["cts-lkft/arm64-v8a.module_foo"])
+        plugin_scratch_mock.objects.create.assert_called_once()
+        storage = plugin_scratch_mock.objects.create.call_args[1]['storage']
+        test_cases, known_issues = tradefed.load_test_cases(storage)
+        self.assertEqual(["TestCaseBar"], [name for name, tests in test_cases])
+        tests = test_cases[0][1]
+        self.assertEqual(5, len(tests))
+        self.assertEqual(2, len([trace for _, _, _, trace in tests if trace is not None]))
+        self.assertEqual({"cts-lkft/arm64-v8a.module_foo/TestCaseBar.test_bar4": [7]}, known_issues)
+        known_issue_mock.active_by_environment.assert_called_once_with(testrun.environment)
+        tasks = chord_mock.call_args[0][0]
+        self.assertEqual(1, len(tasks))
+        self.assertEqual((22, "cts-lkft/arm64-v8a.module_foo", 33, 11), tasks[0].args)
+
+    @patch("tradefed.celery_chord")
+    @patch("tradefed.PluginScratch")
+    @patch("tradefed.get_suites")
+    @patch("tradefed.KnownIssue")
+    def test_extract_cts_results_broken_xml(self, known_issue_mock, get_suites_mock, plugin_scratch_mock, chord_mock):
+        broken_xml = XML_RESULTS[:XML_RESULTS.index("</Module>")]
+        self.plugin._extract_cts_results(BytesIO(broken_xml.encode('utf-8')), Mock(), "cts-lkft")
+        # nothing is dispatched for a file that can't be parsed to the end
+        get_suites_mock.assert_not_called()
+        plugin_scratch_mock.objects.create.assert_not_called()
+        chord_mock.assert_not_called()
+
+    @override_settings(PLUGINS_TRADEFED_QUEUE="tradefed", PLUGINS_TRADEFED_STATUS_QUEUE="tradefed_status", PLUGINS_TRADEFED_TASK_PRIORITY=3)
+    @patch("tradefed.celery_chord")
+    @patch("tradefed.PluginScratch")
+    @patch("tradefed.get_suites")
+    @patch("tradefed.KnownIssue")
+    def test_extract_cts_results_queues(self, known_issue_mock, get_suites_mock, plugin_scratch_mock, chord_mock):
+        known_issue_mock.active_by_environment.return_value = []
+        get_suites_mock.return_value = {"cts-lkft/arm64-v8a.module_foo": Mock()}
+        self.plugin._extract_cts_results(BytesIO(XML_RESULTS.encode('utf-8')), Mock(), "cts-lkft")
+        task = chord_mock.call_args[0][0][0]
+        self.assertEqual("tradefed", task.options['queue'])
+        self.assertEqual(3, task.options['priority'])
+        callback = chord_mock.return_value.call_args[0][0]
+        self.assertEqual("tradefed_status", callback.options['queue'])
+
+    @override_settings(PLUGINS_TRADEFED_BATCH_MAX_TESTS=7)
+    @patch("tradefed.celery_chord")
+    @patch("tradefed.PluginScratch")
+    @patch("tradefed.get_suites")
+    @patch("tradefed.KnownIssue")
+    def test_extract_cts_results_batches(self, known_issue_mock, get_suites_mock, plugin_scratch_mock, chord_mock):
+        known_issue_mock.active_by_environment.return_value = []
+        get_suites_mock.return_value = {"cts-lkft/arm64-v8a.module_foo": Mock()}
+        test_case = XML_RESULTS[XML_RESULTS.index("<TestCase "):XML_RESULTS.index("</TestCase>") + len("</TestCase>")]
+        test_cases = [test_case.replace("TestCaseBar", "TestCase%d" % index) for index in range(3)]
+        xml_results = XML_RESULTS.replace(test_case, "".join(test_cases))
+        self.plugin._extract_cts_results(BytesIO(xml_results.encode('utf-8')), Mock(), "cts-lkft")
+        storages = [tradefed.load_test_cases(call[1]['storage'])[0] for call in plugin_scratch_mock.objects.create.call_args_list]
+        self.assertEqual(
+            [["TestCase0"], ["TestCase1"], ["TestCase2"]],
+            [[name for name, tests in storage] for storage in storages])
+        self.assertEqual(3, len(chord_mock.call_args[0][0]))
+
+        plugin_scratch_mock.reset_mock()
+        with override_settings(PLUGINS_TRADEFED_BATCH_MAX_TESTS=10):
+            self.plugin._extract_cts_results(BytesIO(xml_results.encode('utf-8')), Mock(), "cts-lkft")
+        storages = [tradefed.load_test_cases(call[1]['storage'])[0] for call in plugin_scratch_mock.objects.create.call_args_list]
+        self.assertEqual(
+            [["TestCase0", "TestCase1"], ["TestCase2"]],
+            [[name for name, tests in storage] for storage in storages])
+
+    @override_settings(PLUGINS_TRADEFED_AGGREGATE_STATUS=True)
+    @patch("tradefed.KnownIssue")
+    @patch("tradefed.get_test_metadata")
+    @patch("tradefed.Test")
+    @patch("tradefed.Suite")
+    @patch("tradefed.TestRun")
+    @patch("tradefed.PluginScratch")
+    def test_create_testcase_tests(self, plugin_scratch_mock, testrun_mock, suite_mock, test_model_mock, get_test_metadata_mock, known_issue_mock):
+        test_case = tradefed.ResultTestCase("TestCaseBar")
+        test_case.tests = [("test_bar1", "pass", None, None), ("test_bar2", "fail", None, "java.lang.Error"), ("test_bar3", "fail", None, None)]
+        known_issues = {"cts-lkft/module_foo/TestCaseBar.test_bar2": [7, 8]}
+        plugin_scratch_mock.objects.get.return_value.storage = tradefed.dump_test_cases([test_case], known_issues)
+        suite_mock.objects.get.return_value = Mock(pk=11, slug="cts-lkft/module_foo")
+        get_test_metadata_mock.side_effect = lambda suite_name, names: {name: Mock() for name in names}
+        test_model_mock.objects.bulk_create.side_effect = lambda tests: [Mock(pk=index) for index in range(len(tests))]
+        result = tradefed.create_testcase_tests(22, "cts-lkft/module_foo", 33, 11)
+        known_issue_mock.active_by_environment.assert_not_called()
+        self.assertEqual({'suite_id': 11, 'tests_pass': 1, 'tests_xfail': 1, 'tests_fail': 1, 'tests_skip': 0}, result)
+        through = test_model_mock.known_issues.through
+        self.assertEqual(
+            [((), {'test_id': 1, 'knownissue_id': 7}), ((), {'test_id': 1, 'knownissue_id': 8})],
+            through.call_args_list)
+        through.objects.bulk_create.assert_called_once()
+        plugin_scratch_mock.objects.get.return_value.delete.assert_called_once_with()
+
+    @override_settings(PLUGINS_TRADEFED_TESTRUN_CONCURRENCY=2)
+    @patch("tradefed.connection")
+    @patch("tradefed.time")
+    @patch("tradefed.transaction")
+    @patch("tradefed.PluginScratch")
+    @patch("tradefed.TestRun")
+    def test_acquire_testrun_slot(self, testrun_mock, plugin_scratch_mock, transaction_mock, time_mock, connection_mock):
+        connection_mock.features.has_select_for_no_key_update = True
+        time_mock.time.return_value = 10000.0
+        testrun_mock.objects.select_for_update.return_value.get.return_value.build_id = 5
+        running = Mock(pk=1, storage="tradefed-slot:44:9000.0")
+        stale = Mock(pk=2, storage="tradefed-slot:44:10.0")
+        slots = [running, stale]
+        deleted = Mock()
+        plugin_scratch_mock.objects.filter.side_effect = lambda **kwargs: slots if 'storage__startswith' in kwargs else deleted
+        plugin_scratch_mock.objects.create.return_value.pk = 3
+        self.assertEqual(3, tradefed.acquire_testrun_slot(44))
+        testrun_mock.objects.select_for_update.assert_called_once_with(no_key=True)
+        testrun_mock.objects.select_for_update.return_value.get.assert_called_once_with(pk=44)
+        plugin_scratch_mock.objects.filter.assert_any_call(build_id=5, storage__startswith="tradefed-slot:44:")
+        plugin_scratch_mock.objects.filter.assert_any_call(pk__in=[2])
+        deleted.delete.assert_called_once_with()
+        plugin_scratch_mock.objects.create.assert_called_once_with(build_id=5, storage="tradefed-slot:44:10000.0")
+
+        plugin_scratch_mock.objects.create.reset_mock()
+        slots = [running, Mock(pk=4, storage="tradefed-slot:44:9500.0")]
+        self.assertFalse(tradefed.acquire_testrun_slot(44))
+        plugin_scratch_mock.objects.create.assert_not_called()
+
+        tradefed.release_testrun_slot(3)
+        plugin_scratch_mock.objects.filter.assert_called_with(pk=3)
+        self.assertEqual(2, deleted.delete.call_count)
+
+    @patch("tradefed.PluginScratch")
+    @patch("tradefed.TestRun")
+    def test_acquire_testrun_slot_unlimited(self, testrun_mock, plugin_scratch_mock):
+        self.assertIsNone(tradefed.acquire_testrun_slot(44))
+        tradefed.release_testrun_slot(None)
+        testrun_mock.objects.select_for_update.assert_not_called()
+        plugin_scratch_mock.objects.filter.assert_not_called()
+
+    @patch("tradefed._create_testcase_tests")
+    @patch("tradefed.acquire_testrun_slot")
+    def test_create_testcase_tests_concurrency_limit(self, acquire_testrun_slot_mock, create_testcase_tests_mock):
+        acquire_testrun_slot_mock.return_value = False
+        with patch.object(tradefed.create_testcase_tests, "retry", side_effect=Retry) as retry_mock:
+            tradefed.create_testcase_tests.push_request(retries=3)
+            try:
+                with self.assertRaises(Retry):
+                    tradefed.create_testcase_tests.run(22, "cts-lkft/module_foo", 33, 11)
+            finally:
+                tradefed.create_testcase_tests.pop_request()
+        retry_mock.assert_called_once_with(countdown=80, max_retries=tradefed.TESTRUN_CONCURRENCY_MAX_RETRIES)
+        create_testcase_tests_mock.assert_not_called()
+
+    @patch("tradefed.release_testrun_slot")
+    @patch("tradefed._create_testcase_tests")
+    @patch("tradefed.acquire_testrun_slot")
+    def test_create_testcase_tests_concurrency_limit_give_up(self, acquire_testrun_slot_mock, create_testcase_tests_mock, release_testrun_slot_mock):
+        acquire_testrun_slot_mock.return_value = False
+        tradefed.create_testcase_tests.push_request(retries=tradefed.TESTRUN_CONCURRENCY_MAX_RETRIES)
+        try:
+            tradefed.create_testcase_tests.run(22, "cts-lkft/module_foo", 33, 11)
+        finally:
+            tradefed.create_testcase_tests.pop_request()
+        create_testcase_tests_mock.assert_called_once_with(22, "cts-lkft/module_foo", 33, 11)
+        release_testrun_slot_mock.assert_called_once_with(None)
+
+    @patch("tradefed.ProjectStatus")
+    @patch("tradefed.transaction")
+    @patch("tradefed.Status")
+    @patch("tradefed.TestRun")
+    def test_update_build_status(self, testrun_mock, status_mock, transaction_mock, project_status_mock):
+        testrun = testrun_mock.objects.get.return_value
+        tr_status = Mock(tests_pass=1, tests_xfail=0, tests_fail=0, tests_skip=0)
+        testrun.status.select_for_update.return_value.get.return_value = tr_status
+        suite_statuses = {
+            11: Mock(tests_pass=0, tests_xfail=0, tests_fail=0, tests_skip=0),
+            12: Mock(tests_pass=0, tests_xfail=0, tests_fail=0, tests_skip=0),
+        }
+        status_mock.objects.select_for_update.return_value.get_or_create.side_effect = lambda test_run, suite_id: (suite_statuses[suite_id], True)
+        results = [
+            {'suite_id': 11, 'tests_pass': 3, 'tests_xfail': 0, 'tests_fail': 2, 'tests_skip': 0},
+            {'suite_id': 12, 'tests_pass': 1, 'tests_xfail': 1, 'tests_fail': 0, 'tests_skip': 4},
+            {'suite_id': 11, 'tests_pass': 5, 'tests_xfail': 0, 'tests_fail': 0, 'tests_skip': 1},
+            0,
+        ]
+        tradefed.update_build_status(results, 33)
+        self.assertEqual((8, 0, 2, 1), (suite_statuses[11].tests_pass, suite_statuses[11].tests_xfail, suite_statuses[11].tests_fail, suite_statuses[11].tests_skip))
+        self.assertEqual((1, 1, 0, 4), (suite_statuses[12].tests_pass, suite_statuses[12].tests_xfail, suite_statuses[12].tests_fail, suite_statuses[12].tests_skip))
+        self.assertEqual((10, 1, 2, 5), (tr_status.tests_pass, tr_status.tests_xfail, tr_status.tests_fail, tr_status.tests_skip))
+        tr_status.save.assert_called_once_with()
+        suite_statuses[11].save.assert_called_once_with()
+        project_status_mock.create_or_update.assert_called_once_with(testrun.build)
+
+    @patch("tradefed.ProjectStatus")
+    @patch("tradefed.Status")
+    @patch("tradefed.TestRun")
+    def test_update_build_status_legacy_results(self, testrun_mock, status_mock, project_status_mock):
+        tradefed.update_build_status([0, 0], 33)
+        status_mock.objects.select_for_update.assert_not_called()
+        project_status_mock.create_or_update.assert_called_once_with(testrun_mock.objects.get.return_value.build)
+
+    @patch("tradefed.SuiteMetadata")
+    def test_get_test_metadata(self, suite_metadata_mock):
+        existing = Mock()
+        existing.name = "TestCaseBar.test_bar1"
+        created = Mock()
+        created.name = "TestCaseBar.test_bar2"
+        suite_metadata_mock.objects.filter.return_value.filter.side_effect = [[existing], [created]]
+        metadata = tradefed.get_test_metadata("cts-lkft/module_foo", ["TestCaseBar.test_bar1", "TestCaseBar.test_bar2", "TestCaseBar.test_bar1"])
+        self.assertEqual({"TestCaseBar.test_bar1": existing, "TestCaseBar.test_bar2": created}, metadata)
+        suite_metadata_mock.assert_called_once_with(suite="cts-lkft/module_foo", name="TestCaseBar.test_bar2", kind='test')
+        suite_metadata_mock.objects.bulk_create.assert_called_once()
+        self.assertTrue(suite_metadata_mock.objects.bulk_create.call_args[1]['ignore_conflicts'])
+        self.assertEqual(["TestCaseBar.test_bar2"], suite_metadata_mock.objects.filter.return_value.filter.call_args[1]['name__in'])
+
+    @patch("tradefed.Suite")
+    @patch("tradefed.SuiteMetadata")
+    def test_get_suites(self, suite_metadata_mock, suite_mock):
+        project = Mock()
+        existing_suite = Mock(slug="cts-lkft/arm64-v8a.module_foo")
+        created_suite = Mock(slug="cts-lkft/arm64-v8a.module_bar")
+        suite_mock.objects.filter.return_value.filter.side_effect = [[existing_suite], [created_suite]]
+        suite_metadata = Mock(suite="cts-lkft/arm64-v8a.module_bar")
+        suite_metadata_mock.objects.filter.return_value.filter.side_effect = [[], [suite_metadata]]
+        suites = tradefed.get_suites(project, ["cts-lkft/arm64-v8a.module_foo", "cts-lkft/arm64-v8a.module_bar"])
+        self.assertEqual({"cts-lkft/arm64-v8a.module_foo": existing_suite, "cts-lkft/arm64-v8a.module_bar": created_suite}, suites)
+        suite_metadata_mock.assert_called_once_with(suite="cts-lkft/arm64-v8a.module_bar", kind='suite')
+        suite_mock.assert_called_once_with(project=project, slug="cts-lkft/arm64-v8a.module_bar", metadata=suite_metadata)
+        self.assertTrue(suite_mock.objects.bulk_create.call_args[1]['ignore_conflicts'])
+
+    def test_dump_test_cases(self):
+        test_case = tradefed.ResultTestCase("TestCaseBar")
+        test_case.tests = [("test_bar1", "pass", None, None), ("test_bar2", "fail", None, "java.lang.Error")]
+        expected = ([("TestCaseBar", test_case.tests)], {"suite/TestCaseBar.test_bar2": [7]})
+        payload = tradefed.dump_test_cases([test_case], {"suite/TestCaseBar.test_bar2": [7]})
+        self.assertTrue(payload.startswith(tradefed.SCRATCH_ZLIB_PREFIX))
+        self.assertEqual(expected, tradefed.load_test_cases(payload))
+        with override_settings(PLUGINS_TRADEFED_SCRATCH_COMPRESS=False):
+            payload = tradefed.dump_test_cases([test_case])
+        self.assertTrue(payload.startswith("{"))
+        self.assertEqual((expected[0], None), tradefed.load_test_cases(payload))
+
+    def test_load_test_cases_xml(self):
+        test_case = XML_RESULTS[XML_RESULTS.index("<TestCase "):XML_RESULTS.index("</TestCase>") + len("</TestCase>")]
+        test_cases, known_issues = tradefed.load_test_cases(test_case)
+        self.assertIsNone(known_issues)
+        self.assertEqual(["TestCaseBar"], [name for name, tests in test_cases])
+        tests = test_cases[0][1]
+        self.assertEqual(("test_bar1", "pass", None, None), tests[0])
+        self.assertEqual(("test_bar4", "fail", None), tests[3][:3])
+        self.assertIn("java.lang.Error", tests[3][3])
+
+    def test_parse_results(self):
+        buf = BytesIO(XML_RESULTS.encode('utf-8'))
+        tradefed_results = self.plugin._parse_results(buf)
+        self.assertEqual(0, buf.tell())
+        self.assertEqual(5, tradefed_results.tests_count)
+        self.assertEqual(1, len(tradefed_results.modules))
+        module = tradefed_results.modules[0]
+        self.assertEqual(("module_foo", "arm64-v8a"), (module.name, module.abi))
+        self.assertEqual(["TestCaseBar"], [test_case.name for test_case in module.test_cases])
+        tests = module.test_cases[0].tests
+        self.assertEqual(("test_bar1", "pass", None, None), tests[0])
+        self.assertEqual(("test_bar4", "fail", None), tests[3][:3])
+        self.assertIn("java.lang.Error", tests[3][3])
+        self.assertIn("test_bar4", tradefed_results.log_index.modules[("module_foo", "arm64-v8a")])
+        self.assertIs(
+            tradefed_results.log_index.modules[("module_foo", "arm64-v8a")],
+            tradefed_results.log_index.modules[("module_foo", None)])
+
+    def test_parse_results_modules_only(self):
+        buf = BytesIO(XML_RESULTS.encode('utf-8'))
+        tradefed_results = self.plugin._parse_results(buf, log_index=False)
+        self.assertEqual(5, tradefed_results.tests_count)
+        self.assertEqual(1, len(tradefed_results.modules))
+        self.assertEqual(5, len(tradefed_results.modules[0].test_cases[0].tests))
+        self.assertIsNone(tradefed_results.log_index)
+
+    def test_parse_results_log_index_only(self):
+        buf = BytesIO(XML_RESULTS.encode('utf-8'))
+        tradefed_results = self.plugin._parse_results(buf, modules=False)
+        self.assertEqual(5, tradefed_results.tests_count)
+        self.assertEqual([], tradefed_results.modules)
+        self.assertIn("test_bar4", tradefed_results.log_index.modules[("module_foo", "arm64-v8a")])
+        self.assertIn("test_bar4", tradefed_results.log_index.tests)
+
+    def test_parse_results_on_module(self):
+        module = XML_RESULTS[XML_RESULTS.index("<Module "):XML_RESULTS.index("</Module>") + len("</Module>")]
+        xml_results = XML_RESULTS.replace(module, module + module.replace("module_foo", "module_bar"))
+        handed_over = []
+        tradefed_results = self.plugin._parse_results(
+            BytesIO(xml_results.encode('utf-8')),
+            log_index=False,
+            on_module=lambda module: handed_over.append((module.name, len(module.test_cases[0].tests))))
+        self.assertEqual([("module_foo", 5), ("module_bar", 5)], handed_over)
+        self.assertEqual([], tradefed_results.modules)
+        self.assertEqual(10, tradefed_results.tests_count)
+
+    def test_parse_module_names(self):
+        buf = BytesIO(XML_RESULTS.encode('utf-8'))
+        self.assertEqual([("module_foo", "arm64-v8a")], self.plugin._parse_module_names(buf))
+        self.assertEqual(0, buf.tell())
+        broken_xml = XML_RESULTS[:XML_RESULTS.index("</Module>")]
+        self.assertIsNone(self.plugin._parse_module_names(BytesIO(broken_xml.encode('utf-8'))))
+
+    def test_parse_results_broken_xml(self):
+        broken_xml = XML_RESULTS[:XML_RESULTS.index("</TestCase>") + len("</TestCase>")]
+        buf = BytesIO(broken_xml.encode('utf-8'))
+        self.assertIsNone(self.plugin._parse_results(buf))
+        self.assertEqual(0, buf.tell())
+
+    def __parse_with_backend(self, backend, xml_results):
+        with override_settings(PLUGINS_TRADEFED_XML_BACKEND=backend):
+            tradefed_results = self.plugin._parse_results(BytesIO(xml_results.encode('utf-8')))
+        if tradefed_results is None:
+            return None
+        modules = [
+            (module.name, module.abi, [(test_case.name, test_case.tests) for test_case in module.test_cases])
+            for module in tradefed_results.modules
+        ]
+        return (modules, tradefed_results.tests_count, tradefed_results.log_index.modules, tradefed_results.log_index.tests)
+
+    def test_get_xml_backend(self):
+        with override_settings(PLUGINS_TRADEFED_XML_BACKEND='etree'):
+            self.assertEqual('etree', tradefed.get_xml_backend(BytesIO()).name)
+        with override_settings(PLUGINS_TRADEFED_XML_BACKEND='lxml'):
+            self.assertEqual('etree', tradefed.get_xml_backend(StringIO()).name)
+        with override_settings(PLUGINS_TRADEFED_XML_BACKEND='lxml'), patch("tradefed.lxml_etree", None):
+            self.assertEqual('etree', tradefed.get_xml_backend(BytesIO()).name)
+
+    @unittest.skipIf(tradefed.lxml_etree is None, "lxml is not installed")
+    def test_parse_results_backends_identical(self):
+        xml_results = XML_RESULTS.replace(
+            "</Result>",
+            "<Module name=\"module_bar\" abi=\"armeabi-v7a\"><!-- comment --></Module></Result>")
+        with override_settings(PLUGINS_TRADEFED_XML_BACKEND='lxml'):
+            self.assertEqual('lxml', tradefed.get_xml_backend(BytesIO()).name)
+        lxml_results = self.__parse_with_backend('lxml', xml_results)
+        etree_results = self.__parse_with_backend('etree', xml_results)
+        self.assertIsNotNone(lxml_results)
+        self.assertEqual(etree_results, lxml_results)
+        self.assertIsNone(lxml_results[2][("module_bar", "armeabi-v7a")])
+
+    @unittest.skipIf(tradefed.lxml_etree is None, "lxml is not installed")
+    def test_parse_results_backends_broken_xml(self):
+        broken_xml = XML_RESULTS[:XML_RESULTS.index("</TestCase>") + len("</TestCase>")]
+        self.assertIsNone(self.__parse_with_backend('lxml', broken_xml))
+        self.assertIsNone(self.__parse_with_backend('etree', broken_xml))
+        self.assertIsNone(self.__parse_with_backend('lxml', ""))
+
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log(self, test_model_mock, transaction_mock):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo")
         type(test_mock).suite = suite_mock
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar4")
         type(test_mock).name = name_mock
-        self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(XML_RESULTS)), [test_mock])
         self.assertIn("java.lang.Error", test_mock.log)
-        test_mock.save.assert_called_once_with()
+        test_model_mock.objects.bulk_update.assert_called_once_with([test_mock], ['log'], batch_size=tradefed.DEFAULT_LOG_UPDATE_BATCH_SIZE)
+        transaction_mock.atomic.assert_called_once_with()
+
+    @override_settings(PLUGINS_TRADEFED_LOG_UPDATE_BATCH_SIZE=10)
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_bulk_update(self, test_model_mock, transaction_mock):
+        test_list = []
+        for name in ["TestCaseBar.test_bar4", "TestCaseBar.test_bar1", "TestCaseBar.test_bar4"]:
+            test_mock = Mock()
+            type(test_mock).suite = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo")
+            type(test_mock).name = PropertyMock(return_value=name)
+            test_list.append(test_mock)
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(XML_RESULTS)), test_list)
+        test_model_mock.objects.bulk_update.assert_called_once_with([test_list[0], test_list[2]], ['log'], batch_size=10)
+        for test_mock in test_list:
+            test_mock.save.assert_not_called()
 
-    def test_assign_test_log_no_slash(self):
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_no_slash(self, test_model_mock, transaction_mock):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft.arm64-v8a.module_foo")
         type(test_mock).suite = suite_mock
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar4")
         type(test_mock).name = name_mock
-        self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
-        test_mock.save.assert_not_called()
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(XML_RESULTS)), [test_mock])
+        test_model_mock.objects.bulk_update.assert_not_called()
 
-    def test_assign_test_log_complex_name(self):
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_complex_name(self, test_model_mock, transaction_mock):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo/TestCaseBar.first_subname/second_subname.third_subname")
         type(test_mock).suite = suite_mock
         name_mock = PropertyMock(return_value="test_bar5_64bit")
         type(test_mock).name = name_mock
-        self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(XML_RESULTS)), [test_mock])
         self.assertIn("java.lang.Error", test_mock.log)
-        test_mock.save.assert_called_once_with()
+        test_model_mock.objects.bulk_update.assert_called_once_with([test_mock], ['log'], batch_size=tradefed.DEFAULT_LOG_UPDATE_BATCH_SIZE)
+        transaction_mock.atomic.assert_called_once_with()
 
-    def test_assign_test_log_empty_list(self):
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_empty_list(self, test_model_mock, transaction_mock):
         buf = StringIO(XML_RESULTS)
-        self.plugin._assign_test_log(buf, [])
+        self.plugin._assign_test_log(self.plugin._parse_results(buf), [])
         self.assertEqual(0, buf.tell())
+        test_model_mock.objects.bulk_update.assert_not_called()
 
-    def test_assign_test_log_missing_trace(self):
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_missing_trace(self, test_model_mock, transaction_mock):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo")
         type(test_mock).suite = suite_mock
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar5")
         type(test_mock).name = name_mock
-        self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
-        test_mock.save.assert_not_called()
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(XML_RESULTS)), [test_mock])
+        test_model_mock.objects.bulk_update.assert_not_called()
 
-    def test_assign_test_log_missing_xml(self):
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_missing_xml(self, test_model_mock, transaction_mock):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo")
         type(test_mock).suite = suite_mock
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar5")
         type(test_mock).name = name_mock
-        self.plugin._assign_test_log(StringIO(), [test_mock])
-        test_mock.save.assert_not_called()
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO()), [test_mock])
+        test_model_mock.objects.bulk_update.assert_not_called()
+
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_module_abi(self, test_model_mock, transaction_mock):
+        xml_results = XML_RESULTS.replace("  </Module>\n", """  </Module>
+  <Module name="module_foo" abi="armeabi-v7a" runtime="34082" done="true" pass="1">
+    <TestCase name="TestCaseBar">
+      <Test result="fail" name="test_bar4" >
+        <Failure message="java.lang.Error">
+          <StackTrace>armeabi-v7a trace</StackTrace>
+        </Failure>
+      </Test>
+      <Test result="pass" name="test_bar5" />
+    </TestCase>
+  </Module>
+""")
+        test_mock = Mock()
+        type(test_mock).suite = PropertyMock(return_value="cts-lkft/armeabi-v7a.module_foo")
+        type(test_mock).name = PropertyMock(return_value="TestCaseBar.test_bar4")
+        # test present in the module, without a StackTrace
+        passed_test_mock = Mock()
+        type(passed_test_mock).suite = PropertyMock(return_value="cts-lkft/armeabi-v7a.module_foo")
+        type(passed_test_mock).name = PropertyMock(return_value="TestCaseBar.test_bar5")
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(xml_results)), [test_mock, passed_test_mock])
+        self.assertEqual("armeabi-v7a trace", test_mock.log)
+        test_model_mock.objects.bulk_update.assert_called_once_with([test_mock], ['log'], batch_size=tradefed.DEFAULT_LOG_UPDATE_BATCH_SIZE)
 
-    def test_assign_test_log_missing_module(self):
+    @patch("tradefed.transaction")
+    @patch("tradefed.Test")
+    def test_assign_test_log_missing_module(self, test_model_mock, transaction_mock):
         test_mock = Mock()
         suite_mock = PropertyMock(return_value="cts-lkft/arm64-v8a.module_foo1")
         type(test_mock).suite = suite_mock
         name_mock = PropertyMock(return_value="TestCaseBar.test_bar5")
         type(test_mock).name = name_mock
-        self.plugin._assign_test_log(StringIO(XML_RESULTS), [test_mock])
-        test_mock.save.assert_not_called()
+        self.plugin._assign_test_log(self.plugin._parse_results(StringIO(XML_RESULTS)), [test_mock])
+        test_model_mock.objects.bulk_update.assert_not_called()
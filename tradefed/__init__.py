@@ -1,34 +1,305 @@
+import base64
+import hashlib
+import io
+import json
 import logging
 import os
+import re
 import requests
+import shutil
 import tarfile
+import tempfile
+import threading
+import time
 import xmlrpc
+import zlib
 import yaml
 import xml.etree.ElementTree as ET
 from celery import chord as celery_chord
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from tempfile import SpooledTemporaryFile
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.db import transaction
+from django.core.files import File
+from django.db import connection, transaction
 from squad.plugins import Plugin as BasePlugin
 from urllib.parse import urljoin
 from squad.celery import app as celery
 from squad.core.utils import join_name
-from squad.core.models import Suite, SuiteMetadata, Test, KnownIssue, Status, TestRun, ProjectStatus, PluginScratch
+from squad.core.models import Attachment, Suite, SuiteMetadata, Test, KnownIssue, Status, TestRun, ProjectStatus, PluginScratch
 from squad.core.tasks import get_suite
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
 
 logger = logging.getLogger()
 
 
-@celery.task(queue='ci_fetch')
+# size of the chunks read from the tarball download stream
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# downloads bigger than this are spooled to a temporary file on disk.
+# Can be overridden with PLUGINS_TRADEFED_SPOOL_MAX_SIZE in django settings
+DEFAULT_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+# size of the chunks used when links in result files are rewritten
+REWRITE_CHUNK_SIZE = 1024 * 1024
+
+# tarball members kept by the plugin: (name substring, ResultFiles attribute)
+RESULT_MEMBERS = (
+    ("test_result.xml", "test_results"),
+    ("compatibility_result.xsl", "test_result_xslt"),
+    ("compatibility_result.css", "test_result_css"),
+    ("logo.png", "test_result_image"),
+    ("tradefed-stdout.txt", "tradefed_stdout"),
+    ("tradefed-logcat.txt", "tradefed_logcat"),
+)
+
+# HTTP connection pooling and timeouts (in seconds). Can be overridden with
+# PLUGINS_TRADEFED_HTTP_POOL_SIZE, PLUGINS_TRADEFED_HTTP_CONNECT_TIMEOUT and
+# PLUGINS_TRADEFED_HTTP_READ_TIMEOUT in django settings
+DEFAULT_HTTP_POOL_SIZE = 10
+DEFAULT_HTTP_CONNECT_TIMEOUT = 10
+DEFAULT_HTTP_READ_TIMEOUT = 300
+# next pages of REST API results are requested by a pool of this many
+# threads, kept for the life of the worker process. Each thread keeps its
+# own sessions, so prefetches reuse their connections
+PAGE_PREFETCH_THREADS = 4
+
+# tarball cache is only used when PLUGINS_TRADEFED_CACHE_DIR is set in django
+# settings. Its size is capped with PLUGINS_TRADEFED_CACHE_MAX_SIZE
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+# temporary files left in the cache by failed or killed downloads are
+# removed on eviction once they are older than this many seconds
+CACHE_STALE_TMP_AGE = 24 * 60 * 60
+
+# initial and maximum number of results requested in one
+# results.get_testsuite_results_yaml call
+XMLRPC_RESULTS_PAGE_SIZE = 500
+XMLRPC_RESULTS_MAX_PAGE_SIZE = 8000
+
+# number of tradefed test definitions in a single job whose results are
+# downloaded and extracted at the same time. Can be overridden with
+# PLUGINS_TRADEFED_FETCH_WORKERS in django settings
+DEFAULT_FETCH_WORKERS = 1
+
+# number of tests whose logs are written with a single UPDATE. Can be
+# overridden with PLUGINS_TRADEFED_LOG_UPDATE_BATCH_SIZE in django settings
+DEFAULT_LOG_UPDATE_BATCH_SIZE = 500
+
+# TestCases of a module are sent to create_testcase_tests in batches of at
+# most this many tests or bytes of test names and stack traces. A TestCase
+# is never split between batches. Can be overridden with
+# PLUGINS_TRADEFED_BATCH_MAX_TESTS and PLUGINS_TRADEFED_BATCH_MAX_SIZE in
+# django settings
+DEFAULT_BATCH_MAX_TESTS = 1000
+DEFAULT_BATCH_MAX_SIZE = 1024 * 1024
+
+# TestCases are handed to create_testcase_tests as JSON. Payloads are zlib
+# compressed unless PLUGINS_TRADEFED_SCRATCH_COMPRESS is False in django
+# settings
+DEFAULT_SCRATCH_COMPRESS = True
+SCRATCH_ZLIB_PREFIX = 'zlib:'
+
+# number of names looked up with a single name__in query when SuiteMetadata
+# rows are resolved in bulk
+METADATA_QUERY_CHUNK_SIZE = 500
+
+# create_testcase_tests returns its status counters, which are added to
+# Status rows once by update_build_status, so tasks don't wait on each
+# other for Status row locks. Opt-in with
+# PLUGINS_TRADEFED_AGGREGATE_STATUS in django settings
+DEFAULT_AGGREGATE_STATUS = False
+STATUS_COUNTERS = ('tests_pass', 'tests_xfail', 'tests_fail', 'tests_skip')
+
+# routing of the result ingestion tasks. create_testcase_tests goes to the
+# default queue and update_build_status to ci_fetch, unless
+# PLUGINS_TRADEFED_QUEUE or PLUGINS_TRADEFED_STATUS_QUEUE are set in django
+# settings. PLUGINS_TRADEFED_TASK_PRIORITY and PLUGINS_TRADEFED_TASK_RATE_LIMIT
+# (celery rate limit string, e.g. '100/m') apply to create_testcase_tests
+DEFAULT_STATUS_QUEUE = 'ci_fetch'
+
+# maximum number of create_testcase_tests tasks running at the same time
+# for one testrun. Every running task holds a PluginScratch row, so the
+# limit applies across all workers. Tasks over the limit are retried after
+# TESTRUN_CONCURRENCY_RETRY_DELAY seconds, doubled on every retry up to
+# TESTRUN_CONCURRENCY_MAX_RETRY_DELAY. After TESTRUN_CONCURRENCY_MAX_RETRIES
+# retries the task runs anyway, so its tests are never lost. Unlimited
+# unless PLUGINS_TRADEFED_TESTRUN_CONCURRENCY is set in django settings
+DEFAULT_TESTRUN_CONCURRENCY = None
+TESTRUN_CONCURRENCY_RETRY_DELAY = 10
+TESTRUN_CONCURRENCY_MAX_RETRY_DELAY = 5 * 60
+TESTRUN_CONCURRENCY_MAX_RETRIES = 10
+# rows left behind by crashed workers stop counting after this many seconds
+TESTRUN_CONCURRENCY_TIMEOUT = 60 * 60
+
+# parser used for test_result.xml: 'auto' (lxml when it is installed),
+# 'lxml' or 'etree'. Can be overridden with PLUGINS_TRADEFED_XML_BACKEND in
+# django settings
+DEFAULT_XML_BACKEND = 'auto'
+
+http_sessions = threading.local()
+prefetch_executor = None
+prefetch_executor_pid = None
+prefetch_executor_lock = threading.Lock()
+
+
+def get_http_session(backend=None, headers=None):
+    """
+    Returns requests session kept for the current thread. Sessions are
+    reused between calls, so connections to the same host are kept alive.
+    There is a separate session for each backend, with backend
+    authentication headers applied once when the session is created.
+    """
+    if not hasattr(http_sessions, 'sessions'):
+        http_sessions.sessions = {}
+    key = (backend, frozenset(headers.items()) if headers else None)
+    session = http_sessions.sessions.get(key)
+    if session is None:
+        pool_size = getattr(settings, 'PLUGINS_TRADEFED_HTTP_POOL_SIZE', DEFAULT_HTTP_POOL_SIZE)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if headers:
+            session.headers.update(headers)
+        http_sessions.sessions[key] = session
+    return session
+
+
+def get_prefetch_executor():
+    """
+    Returns the thread pool used to prefetch pages, created on first use
+    in every process, as threads don't survive a fork of the worker.
+    """
+    global prefetch_executor, prefetch_executor_pid
+    with prefetch_executor_lock:
+        if prefetch_executor is None or prefetch_executor_pid != os.getpid():
+            prefetch_executor = ThreadPoolExecutor(max_workers=PAGE_PREFETCH_THREADS, thread_name_prefix='tradefed-prefetch')
+            prefetch_executor_pid = os.getpid()
+        return prefetch_executor
+
+
+def attachment_has_old_data():
+    return any(field.name == 'old_data' for field in Attachment._meta.get_fields())
+
+
+def get_http_timeout():
+    return (
+        getattr(settings, 'PLUGINS_TRADEFED_HTTP_CONNECT_TIMEOUT', DEFAULT_HTTP_CONNECT_TIMEOUT),
+        getattr(settings, 'PLUGINS_TRADEFED_HTTP_READ_TIMEOUT', DEFAULT_HTTP_READ_TIMEOUT),
+    )
+
+
+def testrun_slot_prefix(testrun_id):
+    return 'tradefed-slot:%s:' % testrun_id
+
+
+def acquire_testrun_slot(testrun_id):
+    """
+    Returns False when PLUGINS_TRADEFED_TESTRUN_CONCURRENCY tasks of the
+    testrun are already running. Otherwise the task is counted with a
+    PluginScratch row, whose ID is returned for release_testrun_slot, or
+    None when there is no limit. Slots are counted with the testrun row
+    locked, so tasks starting at the same time can't both take the last
+    slot. The lock is FOR NO KEY UPDATE, which doesn't block the Test and
+    Status rows other tasks insert for the testrun.
+    """
+    limit = getattr(settings, 'PLUGINS_TRADEFED_TESTRUN_CONCURRENCY', DEFAULT_TESTRUN_CONCURRENCY)
+    if not limit:
+        return None
+    prefix = testrun_slot_prefix(testrun_id)
+    now = time.time()
+    with transaction.atomic():
+        # not all databases have FOR NO KEY UPDATE (e.g. MySQL)
+        no_key = connection.features.has_select_for_no_key_update
+        testrun = TestRun.objects.select_for_update(no_key=no_key).get(pk=testrun_id)
+        slots = PluginScratch.objects.filter(build_id=testrun.build_id, storage__startswith=prefix)
+        running = 0
+        stale_slots = []
+        for slot in slots:
+            if now - float(slot.storage[len(prefix):]) > TESTRUN_CONCURRENCY_TIMEOUT:
+                stale_slots.append(slot.pk)
+            else:
+                running += 1
+        if stale_slots:
+            PluginScratch.objects.filter(pk__in=stale_slots).delete()
+        if running >= limit:
+            return False
+        slot = PluginScratch.objects.create(build_id=testrun.build_id, storage='%s%s' % (prefix, now))
+    return slot.pk
+
+
+def release_testrun_slot(slot_id):
+    if slot_id is None:
+        return
+    PluginScratch.objects.filter(pk=slot_id).delete()
+
+
+def get_task_options():
+    """
+    Returns celery options for create_testcase_tests and
+    update_build_status signatures.
+    """
+    task_options = {}
+    queue = getattr(settings, 'PLUGINS_TRADEFED_QUEUE', None)
+    if queue:
+        task_options['queue'] = queue
+    priority = getattr(settings, 'PLUGINS_TRADEFED_TASK_PRIORITY', None)
+    if priority is not None:
+        task_options['priority'] = priority
+    status_options = {'queue': getattr(settings, 'PLUGINS_TRADEFED_STATUS_QUEUE', DEFAULT_STATUS_QUEUE)}
+    return task_options, status_options
+
+
+@celery.task(queue=DEFAULT_STATUS_QUEUE)
 def update_build_status(results_list, testrun_id):
     testrun = TestRun.objects.get(pk=testrun_id)
+    # results of create_testcase_tests that ran in aggregation mode hold
+    # status counters for one suite. Tasks that updated Status rows
+    # themselves return 0
+    suite_counters = {}
+    for result in results_list or []:
+        if not isinstance(result, dict):
+            continue
+        counters = suite_counters.setdefault(result['suite_id'], dict.fromkeys(STATUS_COUNTERS, 0))
+        for counter in STATUS_COUNTERS:
+            counters[counter] += result.get(counter, 0)
+    if suite_counters:
+        testrun_counters = dict.fromkeys(STATUS_COUNTERS, 0)
+        with transaction.atomic():
+            for suite_id, counters in suite_counters.items():
+                suite_status, _ = Status.objects.select_for_update().get_or_create(test_run=testrun, suite_id=suite_id)
+                for counter in STATUS_COUNTERS:
+                    setattr(suite_status, counter, getattr(suite_status, counter) + counters[counter])
+                    testrun_counters[counter] += counters[counter]
+                suite_status.save()
+            tr_status = testrun.status.select_for_update().get(suite=None)
+            for counter in STATUS_COUNTERS:
+                setattr(tr_status, counter, getattr(tr_status, counter) + testrun_counters[counter])
+            tr_status.save()
     ProjectStatus.create_or_update(testrun.build)
 
 
-@celery.task
-def create_testcase_tests(test_case_string_storage_id, atomic_test_suite_name, testrun_id, suite_id):
+@celery.task(bind=True, rate_limit=getattr(settings, 'PLUGINS_TRADEFED_TASK_RATE_LIMIT', None))
+def create_testcase_tests(self, test_case_string_storage_id, atomic_test_suite_name, testrun_id, suite_id):
+    slot_id = acquire_testrun_slot(testrun_id)
+    if slot_id is False:
+        retries = self.request.retries
+        if retries < TESTRUN_CONCURRENCY_MAX_RETRIES:
+            logger.debug("Too many tasks running for testrun %s, retrying" % testrun_id)
+            countdown = min(TESTRUN_CONCURRENCY_RETRY_DELAY * 2 ** retries, TESTRUN_CONCURRENCY_MAX_RETRY_DELAY)
+            raise self.retry(countdown=countdown, max_retries=TESTRUN_CONCURRENCY_MAX_RETRIES)
+        logger.warning("Too many tasks running for testrun %s, running anyway" % testrun_id)
+        slot_id = None
+    try:
+        return _create_testcase_tests(test_case_string_storage_id, atomic_test_suite_name, testrun_id, suite_id)
+    finally:
+        release_testrun_slot(slot_id)
+
+
+def _create_testcase_tests(test_case_string_storage_id, atomic_test_suite_name, testrun_id, suite_id):
     test_case_string = None
     scratch_object = None
     try:
@@ -38,7 +309,7 @@ def create_testcase_tests(test_case_string_storage_id, atomic_test_suite_name, t
         logger.warning("PluginScratch with ID: %s doesn't exist" % test_case_string_storage_id)
         return
 
-    test_case = ET.fromstring(test_case_string)
+    test_cases, known_issues = load_test_cases(test_case_string)
     testrun = TestRun.objects.get(pk=testrun_id)
     suite = Suite.objects.get(pk=suite_id)
     local_status = {
@@ -47,30 +318,33 @@ def create_testcase_tests(test_case_string_storage_id, atomic_test_suite_name, t
         'tests_fail': 0,
         'tests_skip': 0
     }
-    issues = {}
-    for issue in KnownIssue.active_by_environment(testrun.environment):
-        issues.setdefault(issue.test_name, [])
-        issues[issue.test_name].append(issue)
+    if known_issues is None:
+        # payloads written without the known issues snapshot
+        known_issues = get_known_issues(testrun.environment)
+
+    atomic_tests = []
+    for test_case_name, tests in test_cases:
+        logger.debug("Extracting TestCase: {test_case_name}".format(test_case_name=test_case_name))
+        logger.debug("Adding {} testcases".format(len(tests)))
+        for test_name, atomic_test_result, skipped, trace in tests:
+            atomic_test_name = "{test_case_name}.{test_name}".format(test_case_name=test_case_name, test_name=test_name)
+            atomic_tests.append((atomic_test_name, atomic_test_result, skipped, trace))
+    test_metadata = get_test_metadata(atomic_test_suite_name, [atomic_test[0] for atomic_test in atomic_tests])
 
-    test_case_name = test_case.get("name")
-    tests = test_case.findall('.//Test')
-    logger.debug("Extracting TestCase: {test_case_name}".format(test_case_name=test_case_name))
-    logger.debug("Adding {} testcases".format(len(tests)))
     test_list = []
-    for atomic_test in tests:
-        atomic_test_result = atomic_test.get("result")
+    test_issue_list = []
+    for atomic_test_name, atomic_test_result, skipped, trace in atomic_tests:
         decoded_test_result = atomic_test_result == 'pass'
-        if atomic_test_result == 'skip' or atomic_test.get("skipped") == "true":
+        if atomic_test_result == 'skip' or skipped == "true":
             decoded_test_result = None
-        atomic_test_name = "{test_case_name}.{test_name}".format(test_case_name=test_case_name, test_name=atomic_test.get("name"))
         atomic_test_log = ""
-        trace_node = atomic_test.find('.//StackTrace')
-        if trace_node is not None:
-            atomic_test_log = trace_node.text
+        if trace is not None:
+            atomic_test_log = trace
 
-        metadata, _ = SuiteMetadata.objects.get_or_create(suite=atomic_test_suite_name, name=atomic_test_name, kind='test')
+        metadata = test_metadata[atomic_test_name]
         full_name = join_name(suite.slug, atomic_test_name)
-        test_issues = issues.get(full_name, [])
+        test_issues = known_issues.get(full_name, [])
+        test_issue_list.append(test_issues)
         test_list.append(Test(
             test_run=testrun,
             suite=suite,
@@ -89,30 +363,162 @@ def create_testcase_tests(test_case_string_storage_id, atomic_test_suite_name, t
         else:
             local_status['tests_skip'] += 1
     created_tests = Test.objects.bulk_create(test_list)
-    for test in created_tests:
-        if test.name in issues.keys():
-            test.known_issues.add(issues[test.name])
+    known_issue_links = []
+    for test, test_issues in zip(created_tests, test_issue_list):
+        for issue_id in test_issues:
+            known_issue_links.append(Test.known_issues.through(test_id=test.pk, knownissue_id=issue_id))
+    if known_issue_links:
+        Test.known_issues.through.objects.bulk_create(known_issue_links, ignore_conflicts=True)
 
-    with transaction.atomic():
-        tr_status = testrun.status.select_for_update().get(suite=None)
-        tr_status.tests_pass += local_status['tests_pass']
-        tr_status.tests_xfail += local_status['tests_xfail']
-        tr_status.tests_fail += local_status['tests_fail']
-        tr_status.tests_skip += local_status['tests_skip']
-        tr_status.save()
-    suite_status, _ = Status.objects.get_or_create(test_run=testrun, suite=suite)
-    with transaction.atomic():
-        suite_status_for_update = Status.objects.select_for_update().get(pk=suite_status.pk)
-        suite_status_for_update.tests_pass += local_status['tests_pass']
-        suite_status_for_update.tests_xfail += local_status['tests_xfail']
-        suite_status_for_update.tests_fail += local_status['tests_fail']
-        suite_status_for_update.tests_skip += local_status['tests_skip']
-        suite_status_for_update.save()
+    aggregate_status = getattr(settings, 'PLUGINS_TRADEFED_AGGREGATE_STATUS', DEFAULT_AGGREGATE_STATUS)
+    if not aggregate_status:
+        with transaction.atomic():
+            tr_status = testrun.status.select_for_update().get(suite=None)
+            tr_status.tests_pass += local_status['tests_pass']
+            tr_status.tests_xfail += local_status['tests_xfail']
+            tr_status.tests_fail += local_status['tests_fail']
+            tr_status.tests_skip += local_status['tests_skip']
+            tr_status.save()
+        suite_status, _ = Status.objects.get_or_create(test_run=testrun, suite=suite)
+        with transaction.atomic():
+            suite_status_for_update = Status.objects.select_for_update().get(pk=suite_status.pk)
+            suite_status_for_update.tests_pass += local_status['tests_pass']
+            suite_status_for_update.tests_xfail += local_status['tests_xfail']
+            suite_status_for_update.tests_fail += local_status['tests_fail']
+            suite_status_for_update.tests_skip += local_status['tests_skip']
+            suite_status_for_update.save()
     logger.info("Deleting PluginScratch with ID: %s" % scratch_object.pk)
     scratch_object.delete()
+    if aggregate_status:
+        local_status['suite_id'] = suite.pk
+        return local_status
     return 0
 
 
+def filter_in_chunks(queryset, field, values):
+    """
+    Yields objects of queryset whose field is one of values, with one
+    field__in query for every METADATA_QUERY_CHUNK_SIZE values.
+    """
+    values = list(values)
+    for index in range(0, len(values), METADATA_QUERY_CHUNK_SIZE):
+        chunk = values[index:index + METADATA_QUERY_CHUNK_SIZE]
+        for obj in queryset.filter(**{field + '__in': chunk}):
+            yield obj
+
+
+def get_test_metadata(suite_name, names):
+    """
+    Returns a map from test name to the SuiteMetadata of that test in
+    suite_name. Existing rows are fetched with name__in queries and the
+    missing ones are created with a single bulk_create.
+    """
+    names = set(names)
+    metadata = {}
+    queryset = SuiteMetadata.objects.filter(suite=suite_name, kind='test')
+    for suite_metadata in filter_in_chunks(queryset, 'name', names):
+        metadata[suite_metadata.name] = suite_metadata
+    missing = names - metadata.keys()
+    if missing:
+        # rows created by a concurrent worker are ignored and fetched again
+        SuiteMetadata.objects.bulk_create(
+            [SuiteMetadata(suite=suite_name, name=name, kind='test') for name in missing],
+            ignore_conflicts=True,
+            batch_size=METADATA_QUERY_CHUNK_SIZE)
+        for suite_metadata in filter_in_chunks(queryset, 'name', missing):
+            metadata[suite_metadata.name] = suite_metadata
+    return metadata
+
+
+def get_suites(project, slugs):
+    """
+    Returns a map from slug to the Suite with that slug in project. Suites
+    and their SuiteMetadata are fetched with slug__in queries and the
+    missing ones are created with bulk_create.
+    """
+    slugs = set(slugs)
+    suites = {}
+    suite_queryset = Suite.objects.filter(project=project)
+    for suite in filter_in_chunks(suite_queryset, 'slug', slugs):
+        suites[suite.slug] = suite
+    missing = slugs - suites.keys()
+    if not missing:
+        return suites
+
+    metadata = {}
+    metadata_queryset = SuiteMetadata.objects.filter(kind='suite')
+    for suite_metadata in filter_in_chunks(metadata_queryset, 'suite', missing):
+        metadata.setdefault(suite_metadata.suite, suite_metadata)
+    missing_metadata = missing - metadata.keys()
+    if missing_metadata:
+        SuiteMetadata.objects.bulk_create(
+            [SuiteMetadata(suite=slug, kind='suite') for slug in missing_metadata],
+            batch_size=METADATA_QUERY_CHUNK_SIZE)
+        for suite_metadata in filter_in_chunks(metadata_queryset, 'suite', missing_metadata):
+            metadata.setdefault(suite_metadata.suite, suite_metadata)
+
+    # suites created by a concurrent job are ignored and fetched again
+    Suite.objects.bulk_create(
+        [Suite(project=project, slug=slug, metadata=metadata[slug]) for slug in missing],
+        ignore_conflicts=True,
+        batch_size=METADATA_QUERY_CHUNK_SIZE)
+    for suite in filter_in_chunks(suite_queryset, 'slug', missing):
+        suites[suite.slug] = suite
+    return suites
+
+
+def get_known_issues(environment):
+    """
+    Returns a map from full test name to the IDs of active known issues
+    of the environment.
+    """
+    issues = {}
+    for issue in KnownIssue.active_by_environment(environment):
+        issues.setdefault(issue.test_name, [])
+        issues[issue.test_name].append(issue.pk)
+    return issues
+
+
+def dump_test_cases(test_cases, known_issues=None):
+    """
+    Serializes TestCases for create_testcase_tests as JSON. test_cases is a
+    list of [test case name, [[name, result, skipped, stack trace], ...]]
+    items and known_issues the part of the get_known_issues map that
+    applies to them.
+    """
+    payload = {'test_cases': [[test_case.name, test_case.tests] for test_case in test_cases]}
+    if known_issues is not None:
+        payload['known_issues'] = known_issues
+    payload = json.dumps(payload, separators=(',', ':'))
+    if getattr(settings, 'PLUGINS_TRADEFED_SCRATCH_COMPRESS', DEFAULT_SCRATCH_COMPRESS):
+        payload = SCRATCH_ZLIB_PREFIX + base64.b64encode(zlib.compress(payload.encode('utf-8'))).decode('ascii')
+    return payload
+
+
+def load_test_cases(payload):
+    """
+    Returns a list of (test case name, tests) pairs and the known issues
+    map stored with dump_test_cases. Tests are (name, result, skipped,
+    stack trace) tuples. Payloads queued before the switch to JSON hold a
+    single TestCase element and no known issues, which are returned as
+    None then.
+    """
+    if payload.startswith(SCRATCH_ZLIB_PREFIX):
+        payload = zlib.decompress(base64.b64decode(payload[len(SCRATCH_ZLIB_PREFIX):])).decode('utf-8')
+    if not payload.lstrip().startswith('<'):
+        payload = json.loads(payload)
+        test_cases = [(name, [tuple(test) for test in tests]) for name, tests in payload['test_cases']]
+        return test_cases, payload.get('known_issues')
+
+    test_case_node = ET.fromstring(payload)
+    tests = []
+    for test_node in test_case_node.findall('.//Test'):
+        trace_node = test_node.find('.//StackTrace')
+        trace = trace_node.text if trace_node is not None else None
+        tests.append((test_node.get('name'), test_node.get('result'), test_node.get('skipped'), trace))
+    return [(test_case_node.get('name'), tests)], None
+
+
 class PaginatedObjectException(Exception):
     pass
 
@@ -132,131 +538,575 @@ class ResultFiles(object):
     tradefed_logcat = None
     tradefed_stdout = None
     tradefed_zipfile = None
+    tradefed_results_url = None
+
+
+def replace_in_stream(source, destination, replacements, chunk_size=REWRITE_CHUNK_SIZE):
+    """
+    Copies source to destination file object replacing all occurrences
+    of replacements keys with their values (all bytes). Data is handled in
+    chunks, the end of each chunk that could be the beginning of a key
+    is carried over to the next one. Returns number of bytes written.
+    """
+    pattern = re.compile(b'|'.join([re.escape(key) for key in replacements.keys()]))
+    keep = max([len(key) for key in replacements.keys()]) - 1
+    length = 0
+    pending = b''
+    while True:
+        chunk = source.read(chunk_size)
+        data = pending + chunk
+        # a match starting before safe_end is always complete
+        safe_end = max(len(data) - keep, 0) if chunk else len(data)
+        position = 0
+        for match in pattern.finditer(data):
+            if match.start() >= safe_end:
+                break
+            length += destination.write(data[position:match.start()])
+            length += destination.write(replacements[match.group()])
+            position = match.end()
+        cut = max(position, safe_end)
+        length += destination.write(data[position:cut])
+        pending = data[cut:]
+        if not chunk:
+            return length
+
+
+class ResultModule(object):
+    __slots__ = ('name', 'abi', 'test_cases')
+
+    def __init__(self, name, abi):
+        self.name = name
+        self.abi = abi
+        self.test_cases = []
+
+
+class ResultTestCase(object):
+    # tests are (name, result, skipped, stack trace) tuples
+    __slots__ = ('name', 'tests')
+
+    def __init__(self, name):
+        self.name = name
+        self.tests = []
+
+
+class TradefedResults(object):
+    """
+    Contents of test_result.xml needed by the plugin, parsed in a single
+    pass. modules holds the top level Modules with their TestCases and
+    log_index is used for assigning stack traces to failed tests.
+    """
+
+    def __init__(self):
+        self.modules = []
+        self.tests_count = 0
+        self.log_index = TestLogIndex()
+
+
+class TestLogIndex(object):
+    """
+    Stack traces from test_result.xml, indexed in a single pass.
+
+    modules maps (name, abi) and (name, None) to the tests of the first
+    matching Module, or to None when that Module has no children.
+    tests maps test names to the first Test with that name in the whole
+    file. Tests are stored as their StackTrace text, or None when there
+    is no StackTrace.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.tests = {}
+
+
+class ElementTreeBackend(object):
+    name = 'etree'
+    ParseError = ET.ParseError
+
+    def iterparse(self, buf):
+        return ET.iterparse(buf, events=('start', 'end'))
+
+    def find_stack_trace(self, elem):
+        return elem.find('.//StackTrace')
+
+
+class LxmlBackend(object):
+    name = 'lxml'
+
+    def __init__(self):
+        self.ParseError = lxml_etree.XMLSyntaxError
+        self.stack_trace_xpath = lxml_etree.XPath('(.//StackTrace)[1]')
+
+    def iterparse(self, buf):
+        # comments and processing instructions are dropped, as ElementTree does
+        return lxml_etree.iterparse(
+            buf,
+            events=('start', 'end'),
+            huge_tree=True,
+            remove_comments=True,
+            remove_pis=True)
+
+    def find_stack_trace(self, elem):
+        nodes = self.stack_trace_xpath(elem)
+        return nodes[0] if nodes else None
+
+
+def get_xml_backend(buf=None):
+    """
+    Returns the parser backend selected with PLUGINS_TRADEFED_XML_BACKEND.
+    lxml only reads binary streams, so text streams are always parsed
+    with ElementTree.
+    """
+    backend = getattr(settings, 'PLUGINS_TRADEFED_XML_BACKEND', DEFAULT_XML_BACKEND)
+    if backend not in ('auto', 'lxml', 'etree'):
+        logger.warning("Unknown tradefed XML backend: %s" % backend)
+        backend = DEFAULT_XML_BACKEND
+    if backend == 'etree' or isinstance(buf, io.TextIOBase):
+        return ElementTreeBackend()
+    if lxml_etree is None:
+        if backend == 'lxml':
+            logger.warning("lxml is not installed, using ElementTree")
+        return ElementTreeBackend()
+    return LxmlBackend()
+
+
+class TeeReader(object):
+    """
+    Read-only file-like object over an iterator of byte chunks.
+    Every chunk pulled from the iterator is also written to sink
+    and, if given, fed to the checksum (a hashlib object).
+    """
+
+    def __init__(self, chunks, sink, checksum=None):
+        self.chunks = iter(chunks)
+        self.sink = sink
+        self.checksum = checksum
+        self.length = 0
+        self.buffer = b''
+        self.offset = 0
+
+    def __fill(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.sink.write(chunk)
+                if self.checksum is not None:
+                    self.checksum.update(chunk)
+                self.length += len(chunk)
+                self.buffer = self.buffer[self.offset:] + chunk
+                self.offset = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.offset < size:
+            if not self.__fill():
+                break
+        end = len(self.buffer) if size < 0 else min(self.offset + size, len(self.buffer))
+        data = self.buffer[self.offset:end]
+        self.offset = end
+        return data
+
+    def drain(self):
+        while self.__fill():
+            self.buffer = b''
+            self.offset = 0
+
+
+class TarballCache(object):
+    """
+    On-disk cache of downloaded result tarballs. Files are stored under
+    the sha256 of their contents and found by URL through small index
+    files, which also keep the ETag/Last-Modified validators used for
+    conditional requests. Least recently used files are removed once the
+    cache grows over max_size bytes, along with the index files pointing
+    to them.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.index_path = os.path.join(path, 'index')
+        self.data_path = os.path.join(path, 'data')
+        os.makedirs(self.index_path, exist_ok=True)
+        os.makedirs(self.data_path, exist_ok=True)
+
+    def __index_file(self, url):
+        return os.path.join(self.index_path, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def __data_file(self, entry):
+        return os.path.join(self.data_path, entry['sha256'])
+
+    def get(self, url):
+        try:
+            with open(self.__index_file(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self.__data_file(entry)):
+            # evicted
+            return None
+        return entry
+
+    def validators(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def open(self, entry):
+        data_file = self.__data_file(entry)
+        try:
+            # modification time is used for LRU eviction
+            os.utime(data_file)
+            return open(data_file, 'rb')
+        except OSError:
+            # evicted by another worker since get()
+            return None
+
+    def new_file(self):
+        return tempfile.NamedTemporaryFile(dir=self.data_path, prefix='.tmp', delete=False)
+
+    def discard(self, new_file, close=True):
+        # an unlinked file can still be read while it's open
+        if close:
+            new_file.close()
+        try:
+            os.unlink(new_file.name)
+        except OSError:
+            pass
+
+    def put(self, url, new_file, entry):
+        # new_file stays open and readable after being moved into place,
+        # or after being discarded if it can't be cached
+        index_file = None
+        try:
+            new_file.flush()
+            os.replace(new_file.name, self.__data_file(entry))
+            index_file = tempfile.NamedTemporaryFile(mode='w', dir=self.index_path, prefix='.tmp', delete=False)
+            with index_file:
+                json.dump(entry, index_file)
+            os.replace(index_file.name, self.__index_file(url))
+        except OSError as e:
+            logger.warning("Unable to cache %s: %s" % (url, e))
+            self.discard(new_file, close=False)
+            if index_file is not None:
+                self.discard(index_file)
+            return
+        try:
+            self.evict()
+        except OSError as e:
+            logger.warning("Unable to evict from tarball cache: %s" % e)
+
+    def __remove_stale_tmp(self, path, now):
+        try:
+            if now - os.stat(path).st_mtime > CACHE_STALE_TMP_AGE:
+                logger.debug("Removing stale %s from tarball cache" % path)
+                os.unlink(path)
+        except OSError:
+            pass
+
+    def __prune_index(self, now):
+        for name in os.listdir(self.index_path):
+            path = os.path.join(self.index_path, name)
+            if name.startswith('.tmp'):
+                self.__remove_stale_tmp(path, now)
+                continue
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if not os.path.exists(self.__data_file(entry)):
+                logger.debug("Removing %s from tarball cache index" % path)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def evict(self):
+        now = time.time()
+        data_files = []
+        for name in os.listdir(self.data_path):
+            path = os.path.join(self.data_path, name)
+            if name.startswith('.tmp'):
+                # downloads in progress are recent, older ones were abandoned
+                self.__remove_stale_tmp(path, now)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            data_files.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum([size for _, size, _ in data_files])
+        for _, size, path in sorted(data_files):
+            if total_size <= self.max_size:
+                break
+            logger.debug("Removing %s from tarball cache" % path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
+        # index files of evicted data, whichever worker evicted it
+        self.__prune_index(now)
+
+
+def get_tarball_cache():
+    path = getattr(settings, 'PLUGINS_TRADEFED_CACHE_DIR', None)
+    if not path:
+        return None
+    max_size = getattr(settings, 'PLUGINS_TRADEFED_CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE)
+    try:
+        return TarballCache(path, max_size)
+    except OSError as e:
+        logger.warning("Tarball cache disabled: %s" % e)
+        return None
 
 
 class Tradefed(BasePlugin):
     name = "Tradefed"
     tradefed_results_url = None
 
-    def __iterate_test_names(self, tradefed_tree, test_suite_name_list, test_name_list, join_char):
+    def __iterate_test_names(self, index, test_suite_name_list, test_name_list, join_char):
         prefix_string = "/".join(test_suite_name_list[2:])
         prefixes = prefix_string.split(".")
-        for index in range(0, len(prefixes)):
-            test_name = ".".join(prefixes[index:]) + join_char + ".".join(test_name_list)
+        for prefix_index in range(0, len(prefixes)):
+            test_name = ".".join(prefixes[prefix_index:]) + join_char + ".".join(test_name_list)
             logger.debug("searching for test: %s" % test_name)
-            log_node = tradefed_tree.find('.//Test[@name="%s"]' % test_name)
-            if log_node is not None:
-                return log_node
+            if test_name in index.tests:
+                return test_name
 
     def _convert_paths(self, testrun, results):
-        base_url = settings.BASE_URL
-        results_stringio = BytesIO()
-        for line in results.test_results.contents:
-            line_to_write = line.decode().replace(
-                "compatibility_result.xsl",
-                "{base_url}/{group_slug}/{project_slug}/build/{build_version}/attachments/testrun/{testrun_id}/compatibility_result.xsl".format(
-                    base_url=base_url,
-                    group_slug=testrun.build.project.group.slug,
-                    project_slug=testrun.build.project.slug,
-                    build_version=testrun.build.version,
-                    testrun_id=testrun.id)
-            )
-            results_stringio.write(line_to_write.encode('utf-8'))
-        results_stringio.seek(0, os.SEEK_END)
-        results.test_results.length = results_stringio.tell()
-        results_stringio.seek(0)
-        results.test_results.contents = results_stringio
+        # links to the files are replaced with links to testrun attachments
+        attachments_url = "{base_url}/{group_slug}/{project_slug}/build/{build_version}/attachments/testrun/{testrun_id}/".format(
+            base_url=settings.BASE_URL,
+            group_slug=testrun.build.project.group.slug,
+            project_slug=testrun.build.project.slug,
+            build_version=testrun.build.version,
+            testrun_id=testrun.id)
+        self.__replace_paths(results.test_results, attachments_url, ["compatibility_result.xsl"])
         if results.test_result_xslt is not None:
-            result_xslt_stringio = BytesIO()
-            for line in results.test_result_xslt.contents:
-                result_xslt_stringio.write(
-                    line.decode().replace(
-                        "compatibility_result.css",
-                        "{base_url}/{group_slug}/{project_slug}/build/{build_version}/attachments/testrun/{testrun_id}/compatibility_result.css".format(
-                            base_url=base_url,
-                            group_slug=testrun.build.project.group.slug,
-                            project_slug=testrun.build.project.slug,
-                            build_version=testrun.build.version,
-                            testrun_id=testrun.id)
-                        ).replace("logo.png", "{base_url}/{group_slug}/{project_slug}/build/{build_version}/attachments/testrun/{testrun_id}/logo.png".format(
-                            base_url=base_url,
-                            group_slug=testrun.build.project.group.slug,
-                            project_slug=testrun.build.project.slug,
-                            build_version=testrun.build.version,
-                            testrun_id=testrun.id)
-                        ).encode('utf-8')
-                    )
-            result_xslt_stringio.seek(0, os.SEEK_END)
-            results.test_result_xslt.length = result_xslt_stringio.tell()
-            result_xslt_stringio.seek(0)
-            results.test_result_xslt.contents = result_xslt_stringio
-
-
-    def __parse_xml_results(self, buf):
+            self.__replace_paths(results.test_result_xslt, attachments_url, ["compatibility_result.css", "logo.png"])
+
+    def __replace_paths(self, extracted_file, attachments_url, file_names):
+        replacements = {}
+        for file_name in file_names:
+            replacements[file_name.encode('utf-8')] = (attachments_url + file_name).encode('utf-8')
+        # the converted file stays spooled and is copied from there to the
+        # attachment storage by _create_testrun_attachment
+        converted_contents = self._spooled_file()
+        extracted_file.length = replace_in_stream(extracted_file.contents, converted_contents, replacements)
+        converted_contents.seek(0)
+        extracted_file.contents = converted_contents
+
+    def _parse_module_names(self, buf):
+        # (name, abi) of the top level Modules, needed to create their suites
+        # before any TestCase is dispatched. Returns None for broken files
+        if buf is None:
+            logger.warning("Results file doesn't exist")
+            return None
+        backend = get_xml_backend(buf)
+        module_names = []
+        depth = 0
+        root = None
+        try:
+            for event, elem in backend.iterparse(buf):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        root = elem
+                    elif depth == 2 and elem.tag == 'Module':
+                        module_names.append((elem.get('name'), elem.get('abi')))
+                    continue
+                if depth == 2:
+                    root.clear()
+                depth -= 1
+        except backend.ParseError as e:
+            logger.warning(e)
+            return None
+        finally:
+            buf.seek(0)
+        return module_names
+
+    def _parse_results(self, buf, modules=True, log_index=True, on_module=None):
+        # test_result.xml is parsed with iterparse into TradefedResults.
+        # Finished elements are cleared, so the DOM is never kept in memory.
+        # modules is only needed by _extract_cts_results and log_index by
+        # _assign_test_log, so callers can skip the one they don't use.
+        # With on_module, every top level Module is handed over as soon as
+        # it ends instead of being kept in modules, so memory use doesn't
+        # grow with the number of tests
         if buf is None:
             logger.warning("Results file doesn't exist")
             return None
         # assume buf is a file-like object
-        tradefed_tree = None
+        backend = get_xml_backend(buf)
+        tradefed_results = TradefedResults()
+        index = tradefed_results.log_index
+        if not log_index:
+            tradefed_results.log_index = None
+        depth = 0
+        root = None
+        top_module = False
+        module = None
+        open_modules = []
+        open_test_cases = []
+        test_depth = 0
         try:
-            tradefed_tree = ET.parse(buf)
-        except ET.ParseError as e:
+            for event, elem in backend.iterparse(buf):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        root = elem
+                    elif elem.tag == 'Module':
+                        if log_index:
+                            module_tests = {}
+                            open_modules.append(module_tests)
+                            for key in [(elem.get('name'), elem.get('abi')), (elem.get('name'), None)]:
+                                index.modules.setdefault(key, module_tests)
+                        if depth == 2:
+                            top_module = True
+                            if modules:
+                                module = ResultModule(elem.get('name'), elem.get('abi'))
+                                if on_module is None:
+                                    tradefed_results.modules.append(module)
+                    elif elem.tag == 'TestCase' and module is not None:
+                        test_case = ResultTestCase(elem.get('name'))
+                        module.test_cases.append(test_case)
+                        open_test_cases.append(test_case)
+                    elif elem.tag == 'Test':
+                        test_depth += 1
+                    continue
+
+                if elem.tag == 'Module':
+                    if log_index:
+                        module_tests = open_modules.pop()
+                        if len(elem) == 0:
+                            # Modules without children are skipped by _assign_test_log
+                            for key in [(elem.get('name'), elem.get('abi')), (elem.get('name'), None)]:
+                                if index.modules[key] is module_tests:
+                                    index.modules[key] = None
+                    if depth == 2:
+                        top_module = False
+                        if module is not None and on_module is not None:
+                            on_module(module)
+                        module = None
+                        root.clear()
+                    else:
+                        elem.clear()
+                elif elem.tag == 'TestCase' and top_module:
+                    if module is not None:
+                        open_test_cases.pop()
+                    elem.clear()
+                elif elem.tag == 'Test':
+                    test_depth -= 1
+                    tradefed_results.tests_count += 1
+                    name = elem.get('name')
+                    trace_node = backend.find_stack_trace(elem)
+                    trace = trace_node.text if trace_node is not None else None
+                    if log_index:
+                        index.tests.setdefault(name, trace)
+                        for module_tests in open_modules:
+                            module_tests.setdefault(name, trace)
+                    if open_test_cases:
+                        test = (name, elem.get('result'), elem.get('skipped'), trace)
+                        for test_case in open_test_cases:
+                            test_case.tests.append(test)
+                    if test_depth == 0:
+                        elem.clear()
+                depth -= 1
+        except backend.ParseError as e:
             logger.warning(e)
             return None
-        buf.seek(0)
-        return tradefed_tree
+        finally:
+            buf.seek(0)
+        return tradefed_results
+
+    def __test_case_batches(self, test_cases):
+        # TestCases are grouped until the batch reaches the configured
+        # number of tests or size of test names and stack traces
+        max_tests = getattr(settings, 'PLUGINS_TRADEFED_BATCH_MAX_TESTS', DEFAULT_BATCH_MAX_TESTS)
+        max_size = getattr(settings, 'PLUGINS_TRADEFED_BATCH_MAX_SIZE', DEFAULT_BATCH_MAX_SIZE)
+        batch = []
+        batch_tests = 0
+        batch_size = 0
+        for test_case in test_cases:
+            tests = len(test_case.tests)
+            size = sum(len(name or '') + len(trace or '') for name, _, _, trace in test_case.tests)
+            if batch and (batch_tests + tests > max_tests or batch_size + size > max_size):
+                yield batch
+                batch = []
+                batch_tests = 0
+                batch_size = 0
+            batch.append(test_case)
+            batch_tests += tests
+            batch_size += size
+        if batch:
+            yield batch
+
+    def __batch_known_issues(self, issues, suite_name, test_cases):
+        batch_issues = {}
+        if not issues:
+            return batch_issues
+        for test_case in test_cases:
+            for test in test_case.tests:
+                full_name = join_name(suite_name, "{test_case_name}.{test_name}".format(test_case_name=test_case.name, test_name=test[0]))
+                if full_name in issues:
+                    batch_issues[full_name] = issues[full_name]
+        return batch_issues
+
+    def __module_suite_name(self, suite_prefix, name, abi):
+        # Naming: Module Name + Test Case Name + Test Name
+        if abi is not None:
+            name = '.'.join([abi, name])
+        return "{suite_prefix}/{module_name}".format(suite_prefix=suite_prefix, module_name=name)
 
     def _extract_cts_results(self, buf, testrun, suite_prefix):
-        tradefed_tree = self.__parse_xml_results(buf)
-        if tradefed_tree is None:
+        # suites are created from a first, light pass over the file. Tests
+        # are read in a second pass and each Module is dispatched when it
+        # ends, so only one Module is kept in memory
+        module_names = self._parse_module_names(buf)
+        if module_names is None:
             return
 
-        issues = {}
-        for issue in KnownIssue.active_by_environment(testrun.environment):
-            issues.setdefault(issue.test_name, [])
-            issues[issue.test_name].append(issue)
+        # known issues are looked up once and sent to the tasks
+        issues = get_known_issues(testrun.environment)
+
+        logger.debug("Modules: {}".format(len(module_names)))
+        logger.debug("Creating suites")
+        suites = get_suites(testrun.build.project, [self.__module_suite_name(suite_prefix, name, abi) for name, abi in module_names])
 
-        test_elems = tradefed_tree.findall(".//Test")
-        logger.debug("Tests: {}".format(len(test_elems)))
-        elems = tradefed_tree.findall('Module')
-        logger.debug("Modules: {}".format(len(elems)))
+        task_options, status_options = get_task_options()
         task_list = []
-        for elem in elems:
-            # Naming: Module Name + Test Case Name + Test Name
-            if 'abi' in elem.attrib.keys():
-                module_name = '.'.join([elem.attrib['abi'], elem.attrib['name']])
-            else:
-                module_name = elem.attrib['name']
-            logger.debug("Extracting tests for module: {}".format(module_name))
-            test_cases = elem.findall('.//TestCase')
-            suite_metadata_list = []
-            suite_list = []
-            logger.debug("Extracting suite names")
-            atomic_test_suite_name = "{suite_prefix}/{module_name}".format(suite_prefix=suite_prefix, module_name=module_name)
-            logger.debug("creating suite metadata: {}".format(atomic_test_suite_name))
-            suite_metadata, _ = SuiteMetadata.objects.get_or_create(suite=atomic_test_suite_name, kind='suite')
-            suite, _ = Suite.objects.get_or_create(slug=atomic_test_suite_name, project=testrun.build.project, defaults={"metadata": suite_metadata})
-            logger.debug("Adding status with suite: {suite_prefix}/{module_name}".format(suite_prefix=suite_prefix, module_name=module_name))
+
+        def dispatch(module):
+            atomic_test_suite_name = self.__module_suite_name(suite_prefix, module.name, module.abi)
+            logger.debug("Extracting tests for suite: {}".format(atomic_test_suite_name))
+            suite = suites[atomic_test_suite_name]
             logger.debug("Creating subtasks for extracting results")
-            for test_case in test_cases:
+            for test_cases in self.__test_case_batches(module.test_cases):
                 plugin_scratch = PluginScratch.objects.create(
                     build=testrun.build,
-                    storage=ET.tostring(test_case).decode('utf-8')
+                    storage=dump_test_cases(test_cases, self.__batch_known_issues(issues, atomic_test_suite_name, test_cases))
                 )
                 logger.debug("Created plugin scratch with ID: %s" % plugin_scratch.pk)
-                task = create_testcase_tests.s(plugin_scratch.pk, atomic_test_suite_name, testrun.pk, suite.pk)
+                task = create_testcase_tests.s(plugin_scratch.pk, atomic_test_suite_name, testrun.pk, suite.pk).set(**task_options)
                 task_list.append(task)
 
-        celery_chord(task_list)(update_build_status.s(testrun.pk))
+        tradefed_results = self._parse_results(buf, log_index=False, on_module=dispatch)
+        if tradefed_results is not None:
+            logger.debug("Tests: {}".format(tradefed_results.tests_count))
 
-    def _assign_test_log(self, buf, test_list):
-        # assume buf is a file-like object
-        logger.debug("About to parse XML from buffer")
-        tradefed_tree = self.__parse_xml_results(buf)
-        if tradefed_tree is None:
+        celery_chord(task_list)(update_build_status.s(testrun.pk).set(**status_options))
+
+    def _assign_test_log(self, tradefed_results, test_list):
+        if tradefed_results is None:
             return
+        index = tradefed_results.log_index
+        updated_tests = []
         for test in test_list:
-            # search in etree for relevant test
+            # search in the index for relevant test
             logger.debug("processing %s/%s" % (test.suite, test.name))
             test_suite_name_list = str(test.suite).split("/")
             if len(test_suite_name_list) <= 1:
@@ -270,102 +1120,259 @@ class Tradefed(BasePlugin):
             test_name_list = test.name.rsplit(".")
             test_name = test_name_list[-1]
             logger.debug("searching for %s log" % test_name)
-            suite_node = None
-            if test_suite_abi is not None:
-                # Module name="VtsKernelLtp" abi="armeabi-v7a"
-                suite_node = tradefed_tree.find('.//Module[@name="%s"][@abi="%s"]' % (test_suite_name, test_suite_abi))
-            else:
-                suite_node = tradefed_tree.find('.//Module[@name="%s"]' % (test_suite_name))
-            if not suite_node:
+            # Module name="VtsKernelLtp" abi="armeabi-v7a"
+            module_tests = index.modules.get((test_suite_name, test_suite_abi))
+            if module_tests is None:
                 logger.debug("Module %s is not present in the log" % test_suite_name)
                 continue
-            log_node = suite_node.find('.//Test[@name="%s"]' % test_name)
-            if log_node is None:
+            log_tests = module_tests
+            if test_name not in log_tests:
+                log_tests = index.tests
                 test_name = ".".join(test_name_list[1:])
                 logger.debug("searching for test: %s" % test_name)
-                log_node = tradefed_tree.find('.//Test[@name="%s"]' % test_name)
-            if log_node is None:
-                log_node = self.__iterate_test_names(tradefed_tree, test_suite_name_list, test_name_list, ".")
-            if log_node is None:
-                log_node = self.__iterate_test_names(tradefed_tree, test_suite_name_list, test_name_list, "/")
-
-            if log_node is not None:
-                trace_node = log_node.find('.//StackTrace')
-                if trace_node is not None:
-                    test.log = trace_node.text
-                    test.save()
+            if test_name not in log_tests:
+                test_name = self.__iterate_test_names(index, test_suite_name_list, test_name_list, ".")
+                if test_name is None:
+                    test_name = self.__iterate_test_names(index, test_suite_name_list, test_name_list, "/")
+
+            if test_name is not None and log_tests[test_name] is not None:
+                test.log = log_tests[test_name]
+                updated_tests.append(test)
+
+        if updated_tests:
+            logger.debug("Saving logs of %s tests" % len(updated_tests))
+            batch_size = getattr(settings, 'PLUGINS_TRADEFED_LOG_UPDATE_BATCH_SIZE', DEFAULT_LOG_UPDATE_BATCH_SIZE)
+            with transaction.atomic():
+                Test.objects.bulk_update(updated_tests, ['log'], batch_size=batch_size)
+
+    def _spooled_file(self):
+        # anything bigger than the threshold is moved from memory to disk
+        max_size = getattr(settings, 'PLUGINS_TRADEFED_SPOOL_MAX_SIZE', DEFAULT_SPOOL_MAX_SIZE)
+        return SpooledTemporaryFile(max_size=max_size)
 
     def _extract_member(self, tar_file, tar_member):
+        # the archive is read as a stream, so member contents have to be
+        # copied out before moving on to the next member
         extracted_container = ExtractedResult()
-        extracted_container.contents = tar_file.extractfile(tar_member)
+        extracted_container.contents = self._spooled_file()
+        shutil.copyfileobj(tar_file.extractfile(tar_member), extracted_container.contents)
+        extracted_container.contents.seek(0)
         extracted_container.length = tar_member.size
         return extracted_container
 
-    def _download_results(self, result_dict):
+    def _extract_results(self, fileobj, results):
+        # single pass over the compressed stream, only wanted members are kept
+        try:
+            with tarfile.open(fileobj=fileobj, mode='r|xz') as t:
+                for member in t:
+                    logger.debug("Available member: %s" % member.name)
+                    if not member.isfile():
+                        continue
+                    for member_name, attribute in RESULT_MEMBERS:
+                        if member_name in member.name:
+                            setattr(results, attribute, self._extract_member(t, member))
+                            logger.debug("%s extracted from %s" % (attribute, member.name))
+                            break
+        except tarfile.TarError as e:
+            logger.warning(e)
+        except EOFError as e:
+            # this can happen when tarfile is corrupted
+            logger.warning(e)
+
+    def _download_results(self, result_dict, use_cache=True):
         results = ResultFiles()
         if 'metadata' in result_dict:
             if 'reference' in result_dict['metadata']:
+                result_tarball_request = None
+                cache = None
+                cached_file = None
                 try:
                     logger.debug("Downloading CTS/VTS log from: %s" % result_dict['metadata']['reference'])
                     self.tradefed_results_url = result_dict['metadata']['reference']
-                    result_tarball_request = requests.get(self.tradefed_results_url)
+                    results.tradefed_results_url = self.tradefed_results_url
+                    if use_cache:
+                        cache = get_tarball_cache()
+                    cache_entry = None
+                    headers = {}
+                    if cache is not None:
+                        cache_entry = cache.get(self.tradefed_results_url)
+                        if cache_entry is not None:
+                            # opened before the request, so the copy can't
+                            # be evicted by another worker before it's used
+                            cached_file = cache.open(cache_entry)
+                            if cached_file is None:
+                                cache_entry = None
+                            else:
+                                headers = cache.validators(cache_entry)
+                    # artifacts may be hosted outside of LAVA, so backend
+                    # authentication is not sent with the download
+                    result_tarball_request = get_http_session().get(
+                        self.tradefed_results_url,
+                        stream=True,
+                        timeout=get_http_timeout(),
+                        headers=headers)
                     if result_tarball_request.status_code == 200:
-                        result_tarball_request.raw.decode_content = True
-                        r = BytesIO(result_tarball_request.content)
                         results.tradefed_zipfile = ExtractedResult()
-                        results.tradefed_zipfile.contents = r
-                        results.tradefed_zipfile.length = len(result_tarball_request.content)
+                        if cache is not None:
+                            try:
+                                results.tradefed_zipfile.contents = cache.new_file()
+                            except OSError as e:
+                                logger.warning("Unable to cache %s: %s" % (self.tradefed_results_url, e))
+                                cache = None
+                        if cache is None:
+                            results.tradefed_zipfile.contents = self._spooled_file()
                         results.tradefed_zipfile.name = result_tarball_request.url.rsplit("/", 1)[1]
                         results.tradefed_zipfile.mimetype = result_tarball_request.headers.get("Content-Type")
-                        logger.debug("Retrieved %s bytes" % r.getbuffer().nbytes)
-                        t = tarfile.open(fileobj=r, mode='r:xz')
-                        for member in t.getmembers():
-                            logger.debug("Available member: %s" % member.name)
-                            if "test_result.xml" in member.name:
-                                results.test_results = self._extract_member(t, member)
-                                logger.debug("test_results object is empty: %s" % (results.test_results is None))
-                            if "compatibility_result.xsl" in member.name:
-                                results.test_result_xslt = self._extract_member(t, member)
-                                logger.debug("test_result_xslt object is empty: %s" % (results.test_result_xslt is None))
-                            if "compatibility_result.css" in member.name:
-                                results.test_result_css = self._extract_member(t, member)
-                                logger.debug("test_result_css object is empty: %s" % (results.test_result_css is None))
-                            if "logo.png" in member.name:
-                                results.test_result_image = self._extract_member(t, member)
-                                logger.debug("test_result_image object is empty: %s" % (results.test_result_image is None))
-                            if "tradefed-stdout.txt" in member.name:
-                                results.tradefed_stdout = self._extract_member(t, member)
-                                logger.debug("tradefed_stdout object is empty: %s" % (results.tradefed_stdout is None))
-                            if "tradefed-logcat.txt" in member.name:
-                                results.tradefed_logcat = self._extract_member(t, member)
-                                logger.debug("tradefed_logcat object is empty: %s" % (results.tradefed_logcat is None))
-                except tarfile.TarError as e:
-                    logger.warning(e)
-                except EOFError as e:
-                    # this can happen when tarfile is corrupted
-                    logger.warning(e)
-                except requests.exceptions.Timeout as e:
+                        # tarball is extracted while it's being downloaded
+                        stream = TeeReader(
+                            result_tarball_request.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+                            results.tradefed_zipfile.contents,
+                            checksum=hashlib.sha256() if cache is not None else None)
+                        try:
+                            self._extract_results(stream, results)
+                            # keep the complete tarball even if extraction stopped early
+                            stream.drain()
+                        except Exception:
+                            if cache is not None:
+                                cache.discard(results.tradefed_zipfile.contents)
+                            raise
+                        results.tradefed_zipfile.contents.seek(0)
+                        results.tradefed_zipfile.length = stream.length
+                        logger.debug("Retrieved %s bytes" % stream.length)
+                        if cache is not None:
+                            cache.put(self.tradefed_results_url, results.tradefed_zipfile.contents, {
+                                'etag': result_tarball_request.headers.get('ETag'),
+                                'last_modified': result_tarball_request.headers.get('Last-Modified'),
+                                'sha256': stream.checksum.hexdigest(),
+                                'length': stream.length,
+                                'name': results.tradefed_zipfile.name,
+                                'mimetype': results.tradefed_zipfile.mimetype,
+                            })
+                    elif cache_entry is not None and result_tarball_request.status_code == 304:
+                        logger.debug("Using cached copy of: %s" % self.tradefed_results_url)
+                        results.tradefed_zipfile = ExtractedResult()
+                        results.tradefed_zipfile.contents = cached_file
+                        cached_file = None
+                        results.tradefed_zipfile.length = cache_entry['length']
+                        results.tradefed_zipfile.name = cache_entry['name']
+                        results.tradefed_zipfile.mimetype = cache_entry['mimetype']
+                        self._extract_results(results.tradefed_zipfile.contents, results)
+                        results.tradefed_zipfile.contents.seek(0)
+                except requests.exceptions.RequestException as e:
+                    # covers timeouts and connections dropped while the
+                    # body is streamed, which requests raises as ConnectionError
                     logger.warning(e)
+                    results = ResultFiles()
+                    results.tradefed_results_url = self.tradefed_results_url
+                except OSError as e:
+                    # full disk or a cache directory shared with other
+                    # workers. The tarball is downloaded again without it
+                    if cache is None:
+                        raise
+                    logger.warning("Tarball cache failed for %s: %s" % (self.tradefed_results_url, e))
+                    results = self._download_results(result_dict, use_cache=False)
+                finally:
+                    if cached_file is not None:
+                        cached_file.close()
+                    if result_tarball_request is not None:
+                        result_tarball_request.close()
         return results
 
-    def __get_paginated_objects(self, url, lava_implementation):
+    def __get_paginated_objects(self, url, backend, headers):
         # this method only applies to REST API
-        object_request = requests.get(url, headers=lava_implementation.authentication)
-        objects = []
-        if object_request.status_code == 200:
-            object_list = object_request.json()
-            objects = object_list['results']
-            while object_list['next']:
-                object_request = requests.get(object_list['next'], headers=lava_implementation.authentication)
-                if object_request.status_code == 200:
-                    object_list = object_request.json()
-                    objects = objects + object_list['results']
-                else:
+        object_request = get_http_session(backend, headers).get(url, timeout=get_http_timeout())
+        if object_request.status_code != 200:
+            raise PaginatedObjectException()
+        return self.__iterate_paginated_objects(object_request.json(), backend, headers)
+
+    def __get_page(self, url, backend, headers):
+        # runs in a prefetch thread, which keeps its own session
+        return get_http_session(backend, headers).get(url, timeout=get_http_timeout())
+
+    def __iterate_paginated_objects(self, object_list, backend, headers):
+        # objects are yielded as soon as their page arrives, next page
+        # is requested in the background while the current one is consumed
+        executor = get_prefetch_executor()
+        next_page = None
+        try:
+            while True:
+                next_page = None
+                if object_list['next']:
+                    next_page = executor.submit(self.__get_page, object_list['next'], backend, headers)
+                for obj in object_list['results']:
+                    yield obj
+                if next_page is None:
+                    break
+                try:
+                    object_request = next_page.result()
+                except requests.exceptions.RequestException as e:
                     # don't raise exception as some results were extracted
+                    logger.warning(e)
                     break
+                if object_request.status_code != 200:
+                    # don't raise exception as some results were extracted
+                    break
+                object_list = object_request.json()
+        finally:
+            # the suite was found before the prefetched page was needed
+            if next_page is not None:
+                next_page.cancel()
+
+    def __load_yaml_results(self, results):
+        try:
+            return yaml.load(results, Loader=yaml.CLoader)
+        except yaml.scanner.ScannerError as e:
+            logger.warning(e)
+            return None
+
+    def __find_test_attachment(self, proxy, job_id, suite_name):
+        # this method only applies to XML-RPC API
+        try:
+            results = proxy.results.get_testcase_results_yaml(job_id, suite_name, 'test-attachment')
+        except xmlrpc.client.Fault as e:
+            if e.faultCode == 404:
+                logger.debug("test-attachment not found in %s" % suite_name)
+                return None
+            # older LAVA, look for test-attachment in the whole suite
+            logger.debug("results.get_testcase_results_yaml failed: %s" % e.faultString)
         else:
-            raise PaginatedObjectException()
-        return objects
+            for result in self.__load_yaml_results(results) or []:
+                if result['name'] == 'test-attachment':
+                    return result
+            return None
+
+        count = None
+        try:
+            count = int(proxy.results.get_testsuite_results_count(job_id, suite_name))
+        except xmlrpc.client.Fault as e:
+            logger.debug("results.get_testsuite_results_count failed: %s" % e.faultString)
+
+        # test-attachment is usually recorded last, so when the number of
+        # results is known, pages are requested from the end of the suite.
+        # Page size grows with every request
+        limit = XMLRPC_RESULTS_PAGE_SIZE
+        end = count
+        offset = 0
+        while end is None or end > 0:
+            if end is not None:
+                offset = max(end - limit, 0)
+            logger.debug("requesting results for %s with offset of %s" % (suite_name, offset))
+            results = proxy.results.get_testsuite_results_yaml(job_id, suite_name, limit, offset)
+            yaml_results = self.__load_yaml_results(results)
+            if not yaml_results:
+                logger.debug("Something went wrong with results.get_testsuite_results_yaml from LAVA")
+                return None
+            if end is not None:
+                # skip results that were already checked
+                yaml_results = reversed(yaml_results[:end - offset])
+                end = offset
+            else:
+                offset = offset + limit
+            for result in yaml_results:
+                if result['name'] == 'test-attachment':
+                    return result
+            limit = min(limit * 2, XMLRPC_RESULTS_MAX_PAGE_SIZE)
+        return None
 
     def _get_from_artifactorial(self, testjob, suite_name):
         logger.debug("Retrieving result summary for job: %s" % testjob.job_id)
@@ -384,52 +1391,26 @@ class Tradefed(BasePlugin):
                 return None
         else:
             suites_url = urljoin(testjob.backend.get_implementation().api_url_base, "jobs/{job_id}/suites/?name__contains={suite_name}".format(job_id=testjob.job_id, suite_name=suite_name))
+            session = get_http_session(testjob.backend.pk, lava_implementation.authentication)
             try:
-                suites = self.__get_paginated_objects(suites_url, lava_implementation)
-            except PaginatedObjectException:
+                suites = self.__get_paginated_objects(suites_url, testjob.backend.pk, lava_implementation.authentication)
+            except (PaginatedObjectException, requests.exceptions.RequestException):
                 logger.error("Unable to retrieve suites for job: {job_id}".format(job_id=testjob.job_id))
                 return None
 
         for suite in suites:
             if suite_name in suite['name']:
                 if lava_implementation.use_xml_rpc:
-                    limit = 500
-                    offset = 0
-                    results = testjob.backend.get_implementation().proxy.results.get_testsuite_results_yaml(
-                        testjob.job_id,
-                        suite['name'],
-                        limit,
-                        offset)
-                    yaml_results = None
+                    result = self.__find_test_attachment(lava_implementation.proxy, testjob.job_id, suite['name'])
+                    if result is not None:
+                        return self._download_results(result)
+                else:
+                    test_attachment_url = urljoin(testjob.backend.get_implementation().api_url_base, "jobs/{job_id}/suites/{suite_id}/tests/?name=test-attachment".format(job_id=testjob.job_id, suite_id=suite['id']))
                     try:
-                        yaml_results = yaml.load(results, Loader=yaml.CLoader)
-                    except yaml.scanner.ScannerError as e:
+                        test_attachment_request = session.get(test_attachment_url, timeout=get_http_timeout())
+                    except requests.exceptions.RequestException as e:
                         logger.warning(e)
                         return None
-
-                    if not yaml_results:
-                        logger.debug("Something went wrong with results.get_testsuite_results_yaml from LAVA")
-                        return None
-
-                    while True:
-                        if len(yaml_results) > 0:
-                            for result in yaml_results:
-                                if result['name'] == 'test-attachment':
-                                    return self._download_results(result)
-                            offset = offset + limit
-                            logger.debug("requesting results for %s with offset of %s"
-                                         % (suite['name'], offset))
-                            results = testjob.backend.get_implementation().proxy.results.get_testsuite_results_yaml(
-                                testjob.job_id,
-                                suite['name'],
-                                limit,
-                                offset)
-                            yaml_results = yaml.load(results, Loader=yaml.CLoader)
-                        else:
-                            break
-                else:
-                    test_attachment_url = urljoin(testjob.backend.get_implementation().api_url_base, "jobs/{job_id}/suites/{suite_id}/tests/?name=test-attachment".format(job_id=testjob.job_id, suite_id=suite['id']))
-                    test_attachment_request = requests.get(test_attachment_url, headers=lava_implementation.authentication)
                     if test_attachment_request.status_code == 200:
                         test_attachmet_results = test_attachment_request.json()
                         for test_result in test_attachmet_results['results']:
@@ -446,15 +1427,78 @@ class Tradefed(BasePlugin):
         logger.debug("actual file size: %s" % extracted_file.contents.tell())
         extracted_file.contents.seek(0)
 
-        data = extracted_file.contents.read()
-        attachment = testrun.attachments.create(
-            filename = name,
-            old_data = data,
-            length = extracted_file.length,
-            mimetype = mimetype
-        )
+        attachment_fields = {
+            'filename': name,
+            'length': extracted_file.length,
+            'mimetype': mimetype,
+        }
+        if attachment_has_old_data():
+            # squad releases before core migration 0148 keep a copy in the database
+            attachment_fields['old_data'] = extracted_file.contents.read()
+            extracted_file.contents.seek(0)
+        attachment = testrun.attachments.create(**attachment_fields)
+
+        # the file is copied to the storage from the (spooled) file object
+        attachment.storage.save('attachment/%s/%s' % (attachment.id, name), File(extracted_file.contents, name=name))
 
-        attachment.storage.save('attachment/%s/%s' % (attachment.id, name), ContentFile(data))
+    def _fetch_results(self, testjob, test_definition):
+        # download and extract results, no database access happens here
+        # as this can run in a worker thread
+        logger.debug("Processing test %s" % test_definition['name'])
+        try:
+            return self._get_from_artifactorial(testjob, test_definition['name']), None
+        except xmlrpc.client.ProtocolError as err:
+            error_cleaned = 'Failed to process CTS/VTS tests: %s - %s' % (err.errcode, testjob.backend.get_implementation().url_remove_token(str(err.errmsg)))
+            return None, error_cleaned
+
+    def _process_results(self, testjob, test_definition, results):
+        logger.debug("Processing results")
+        if results is not None:
+            # add metadata key for taball download
+            results_url = results.tradefed_results_url
+            if results_url is None:
+                results_url = self.tradefed_results_url
+            testjob.testrun.metadata["tradefed_results_url_%s" % testjob.job_id] = results_url
+            logger.debug("about to save testrun")
+            testjob.testrun.save()
+            logger.debug("testrun saved")
+            # only failed tests have logs
+            if testjob.testrun is not None:
+                ps = None
+                if testjob.target.project_settings is not None:
+                    ps = yaml.safe_load(testjob.target.project_settings)
+                aggregated = bool(
+                    ps and ps.get("PLUGINS_TRADEFED_EXTRACT_AGGREGATED", False) and
+                    'params' in test_definition.keys() and
+                    ('RESULTS_FORMAT' not in test_definition['params'] or ('RESULTS_FORMAT' in test_definition['params'] and test_definition['params']['RESULTS_FORMAT'] == 'aggregated')))
+                if aggregated:
+                    # extract_cts_results also assigns the log
+                    if results.test_results is not None:
+                        self._extract_cts_results(results.test_results.contents, testjob.testrun, test_definition['name'])
+                else:
+                    failed = testjob.testrun.tests.filter(result=False)
+                    if results.test_results is not None:
+                        tradefed_results = self._parse_results(results.test_results.contents, modules=False)
+                        self._assign_test_log(tradefed_results, failed)
+                if results.test_results is not None:
+                    self._convert_paths(testjob.testrun, results)
+                    self._create_testrun_attachment(testjob.testrun, "test_results.xml", results.test_results, "application/xml")
+                if results.test_result_xslt is not None:
+                    self._create_testrun_attachment(testjob.testrun, "compatibility_result.xsl", results.test_result_xslt, "application/xslt+xml")
+                if results.test_result_css is not None:
+                    self._create_testrun_attachment(testjob.testrun, "compatibility_result.css", results.test_result_css, "text/css")
+                if results.test_result_image is not None:
+                    self._create_testrun_attachment(testjob.testrun, "logo.png", results.test_result_image, "image/png")
+                if results.tradefed_stdout is not None:
+                    self._create_testrun_attachment(testjob.testrun, "teadefed_stdout.txt", results.tradefed_stdout, "text/plain")
+                if results.tradefed_logcat is not None:
+                    self._create_testrun_attachment(testjob.testrun, "teadefed_logcat.txt", results.tradefed_logcat, "text/plain")
+                if results.tradefed_zipfile is not None:
+                    if results.tradefed_zipfile.mimetype is None:
+                        results.tradefed_zipfile.mimetype = "application/x-tar"
+                    if results.tradefed_zipfile.name is None:
+                        results.tradefed_zipfile.name = "tradefed.tar.gz"
+                    self._create_testrun_attachment(testjob.testrun, results.tradefed_zipfile.name, results.tradefed_zipfile, results.tradefed_zipfile.mimetype)
 
     def postprocess_testjob(self, testjob):
         # get related testjob
@@ -469,65 +1513,32 @@ class Tradefed(BasePlugin):
             logger.debug("Loading test job definition")
             job_definition = yaml.load(testjob.definition, Loader=yaml.CLoader)
             # find all tests
+            tradefed_definitions = []
             if 'actions' in job_definition.keys():
                 for test_action in [action for action in job_definition['actions'] if'test' in action.keys()]:
                     if 'definitions' not in test_action['test'].keys():
                         continue
                     for test_definition in test_action['test']['definitions']:
-                        logger.debug("Processing test %s" % test_definition['name'])
                         if "tradefed.yaml" in test_definition['path']:  # is there any better heuristic?
-                            # download and parse results
-                            results = None
-                            try:
-                                results = self._get_from_artifactorial(testjob, test_definition['name'])
-                            except xmlrpc.client.ProtocolError as err:
-                                error_cleaned = 'Failed to process CTS/VTS tests: %s - %s' % (err.errcode, testjob.backend.get_implementation().url_remove_token(str(errmsg)))
-                                logger.warning(error_cleaned)
-
-                                testjob.failure += error_cleaned 
-                                testjob.save()
-
-                            logger.debug("Processing results")
-                            if results is not None:
-                                # add metadata key for taball download
-                                testjob.testrun.metadata["tradefed_results_url_%s" % testjob.job_id] = self.tradefed_results_url
-                                logger.debug("about to save testrun")
-                                testjob.testrun.save()
-                                logger.debug("testrun saved")
-                                # only failed tests have logs
-                                if testjob.testrun is not None:
-                                    ps = None
-                                    if testjob.target.project_settings is not None:
-                                        ps = yaml.safe_load(testjob.target.project_settings)
-                                    if ps and ps.get("PLUGINS_TRADEFED_EXTRACT_AGGREGATED", False) and \
-                                            'params' in test_definition.keys() and \
-                                            ('RESULTS_FORMAT' not in test_definition['params'] or ('RESULTS_FORMAT' in test_definition['params'] and test_definition['params']['RESULTS_FORMAT'] == 'aggregated')):
-                                        # extract_cts_results also assigns the log
-                                        if results.test_results is not None:
-                                            self._extract_cts_results(results.test_results.contents, testjob.testrun, test_definition['name'])
-                                    else:
-                                        failed = testjob.testrun.tests.filter(result=False)
-                                        if results.test_results is not None:
-                                            self._assign_test_log(results.test_results.contents, failed)
-                                    if results.test_results is not None:
-                                        self._convert_paths(testjob.testrun, results)
-                                        self._create_testrun_attachment(testjob.testrun, "test_results.xml", results.test_results, "application/xml")
-                                    if results.test_result_xslt is not None:
-                                        self._create_testrun_attachment(testjob.testrun, "compatibility_result.xsl", results.test_result_xslt, "application/xslt+xml")
-                                    if results.test_result_css is not None:
-                                        self._create_testrun_attachment(testjob.testrun, "compatibility_result.css", results.test_result_css, "text/css")
-                                    if results.test_result_image is not None:
-                                        self._create_testrun_attachment(testjob.testrun, "logo.png", results.test_result_image, "image/png")
-                                    if results.tradefed_stdout is not None:
-                                        self._create_testrun_attachment(testjob.testrun, "teadefed_stdout.txt", results.tradefed_stdout, "text/plain")
-                                    if results.tradefed_logcat is not None:
-                                        self._create_testrun_attachment(testjob.testrun, "teadefed_logcat.txt", results.tradefed_logcat, "text/plain")
-                                    if results.tradefed_zipfile is not None:
-                                        if results.tradefed_zipfile.mimetype is None:
-                                            results.tradefed_zipfile.mimetype = "application/x-tar"
-                                        if results.tradefed_zipfile.name is None:
-                                            results.tradefed_zipfile.name = "tradefed.tar.gz"
-                                        self._create_testrun_attachment(testjob.testrun, results.tradefed_zipfile.name, results.tradefed_zipfile, results.tradefed_zipfile.mimetype)
+                            tradefed_definitions.append(test_definition)
+
+            # results of all definitions can be downloaded and extracted
+            # in parallel, database is only updated from this thread
+            workers = min(getattr(settings, 'PLUGINS_TRADEFED_FETCH_WORKERS', DEFAULT_FETCH_WORKERS), len(tradefed_definitions))
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    fetched = executor.map(lambda d: self._fetch_results(testjob, d), tradefed_definitions)
+                    self._process_fetched_results(testjob, tradefed_definitions, fetched)
+            else:
+                fetched = (self._fetch_results(testjob, d) for d in tradefed_definitions)
+                self._process_fetched_results(testjob, tradefed_definitions, fetched)
         logger.info("Finishing CTS/VTS plugin for test run: %s" % testjob)
 
+    def _process_fetched_results(self, testjob, tradefed_definitions, fetched):
+        for test_definition, (results, error) in zip(tradefed_definitions, fetched):
+            if error is not None:
+                logger.warning(error)
+                testjob.failure += error
+                testjob.save()
+            self._process_results(testjob, test_definition, results)
 